@@ -0,0 +1,45 @@
+"""
+Compare two benchmark result files written by ``pytest benchmarks``::
+
+    python benchmarks/compare.py old.json new.json
+"""
+
+import argparse
+import json
+
+
+def load(filename):
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def rows(old, new):
+    for name in sorted(old["benchmarks"].keys() & new["benchmarks"].keys()):
+        old_result = old["benchmarks"][name]
+        new_result = new["benchmarks"][name]
+        for metric, unit, scale in [("timings", "s", 1), ("peak_memory", "MiB", 2**20)]:
+            for phase in old_result[metric].keys() & new_result[metric].keys():
+                before = old_result[metric][phase] / scale
+                after = new_result[metric][phase] / scale
+                change = f"{(after - before) / before:+.1%}" if before else "n/a"
+                yield f"{name}.{metric}.{phase}", f"{before:.2f} {unit}", f"{after:.2f} {unit}", change
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("old", help="results of the baseline")
+    parser.add_argument("new", help="results to compare to the baseline")
+    args = parser.parse_args(argv)
+
+    old = load(args.old)
+    new = load(args.new)
+    print(f"old: {old['environment']['revision']}\nnew: {new['environment']['revision']}\n")
+
+    table = [("benchmark", "old", "new", "change"), *sorted(rows(old, new))]
+    widths = [max(len(row[i]) for row in table) for i in range(4)]
+    for row in table:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import pytest
+from harness import write_results
+
+pytest_plugins = ["sphinx.testing.fixtures"]
+
+RESULTS_KEY = pytest.StashKey[dict]()
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark-json",
+        default="benchmark-results.json",
+        help="file the results of the benchmarks are written to (default: %(default)s)",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: benchmark of the build performance")
+    config.stash[RESULTS_KEY] = {}
+
+
+def pytest_unconfigure(config):
+    results = config.stash.get(RESULTS_KEY, None)
+    if results:
+        write_results(config.getoption("--benchmark-json"), results)
+
+
+@pytest.fixture
+def benchmark_results(request):
+    """Results of the benchmarks, keyed by the name of the benchmark"""
+    return request.config.stash[RESULTS_KEY]
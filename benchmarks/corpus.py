@@ -0,0 +1,122 @@
+"""
+Generator of synthetic schema corpora for the benchmarks.
+
+The shape of a corpus is described by a dict of parameters (see
+`DEFAULT_CORPUS`), and the same parameters always generate the same corpus
+so that results can be compared between commits.
+"""
+
+import random
+
+import yaml
+
+DEFAULT_CORPUS = {
+    # Number of schema files
+    "schemas": 20,
+    # Number of properties of each object
+    "fanout": 4,
+    # Levels of nested objects below the top level of each schema
+    "depth": 2,
+    # Fraction of the properties that are an anyOf or oneOf combiner
+    "combiner_density": 0.2,
+    # Number of values of enum properties
+    "enum_size": 8,
+    # Fraction of the properties that $ref another schema of the corpus
+    "ref_density": 0.1,
+    # Seed of the random generator
+    "seed": 0,
+}
+
+DESCRIPTION = """\
+The `{name}` property is *generated* for the benchmarks.
+
+It is described by a few paragraphs of **markdown**, including a
+[link](https://asdf-standard.readthedocs.io) and a list:
+
+* first item
+* second item
+"""
+
+
+class CorpusGenerator:
+    def __init__(self, schemas, fanout, depth, combiner_density, enum_size, ref_density, seed):
+        self.schemas = schemas
+        self.fanout = fanout
+        self.depth = depth
+        self.combiner_density = combiner_density
+        self.enum_size = enum_size
+        self.ref_density = ref_density
+        self.rng = random.Random(seed)  # noqa: S311
+        self.index = 0
+
+    def schema_name(self, index):
+        return f"schema{index}"
+
+    def leaf(self, name):
+        kind = self.rng.choice(["string", "number", "enum", "array"])
+        if kind == "enum":
+            return {"type": "string", "enum": [f"{name}{i}" for i in range(self.enum_size)]}
+        if kind == "array":
+            return {"type": "array", "items": {"type": "number"}, "minItems": 1}
+        return {"type": kind}
+
+    def combiner(self, name, level):
+        combiner = self.rng.choice(["anyOf", "oneOf"])
+        return {combiner: [self.property(f"{name}{i}", level + 1) for i in range(2)] + [{"type": "null"}]}
+
+    def reference(self):
+        # Any schema other than the one being generated
+        other = self.rng.randrange(self.schemas - 1)
+        return {"$ref": self.schema_name(other if other < self.index else other + 1)}
+
+    def obj(self, name, level):
+        properties = {f"{name}_{i}": self.property(f"{name}_{i}", level + 1) for i in range(self.fanout)}
+        return {"type": "object", "properties": properties, "required": list(properties)[:2]}
+
+    def property(self, name, level):
+        roll = self.rng.random()
+        if self.schemas > 1 and roll < self.ref_density:
+            schema = self.reference()
+        elif level < self.depth and roll < self.ref_density + self.combiner_density:
+            schema = self.combiner(name, level)
+        elif level < self.depth:
+            schema = self.obj(name, level)
+        else:
+            schema = self.leaf(name)
+        return {"title": f"The *{name}* property", "description": DESCRIPTION.format(name=name), **schema}
+
+    def schema(self, index):
+        self.index = index
+        name = self.schema_name(index)
+        return {
+            "$schema": "http://stsci.edu/schemas/yaml-schema/draft-01",
+            "id": f"http://stsci.edu/schemas/sphinx-asdf/benchmark/{name}-1.0.0",
+            "tag": f"tag:stsci.edu:sphinx-asdf/benchmark/{name}-1.0.0",
+            "title": f"Benchmark schema {index}",
+            "description": DESCRIPTION.format(name=name),
+            "type": "object",
+            "properties": {f"prop{i}": self.property(f"prop{i}", 0) for i in range(self.fanout)},
+        }
+
+
+def write_corpus(srcdir, **params):
+    """
+    Write a project documenting a synthetic schema corpus to ``srcdir`` and
+    return the parameters of the corpus.
+    """
+    params = {**DEFAULT_CORPUS, **params}
+    generator = CorpusGenerator(**params)
+
+    schema_dir = srcdir / "schemas"
+    schema_dir.mkdir(parents=True)
+    names = []
+    for index in range(generator.schemas):
+        name = generator.schema_name(index)
+        content = yaml.safe_dump(generator.schema(index), sort_keys=False)
+        (schema_dir / f"{name}.yaml").write_text(f"%YAML 1.1\n---\n{content}...\n")
+        names.append(name)
+
+    schemas = "\n".join(f"   {name}" for name in names)
+    (srcdir / "contents.rst").write_text(f"Schemas\n=======\n\n.. asdf-autoschemas::\n\n{schemas}\n")
+    (srcdir / "conf.py").write_text('extensions = ["sphinx_asdf"]\nmaster_doc = "contents"\n')
+    return params
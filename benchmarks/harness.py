@@ -0,0 +1,108 @@
+"""
+Instrumentation of a Sphinx build that times (and measures the peak memory
+of) each of the phases of the build that sphinx-asdf contributes to.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from importlib.metadata import version
+
+import sphinx_asdf
+from sphinx_asdf.directives import AsdfSchema
+
+# The phases of a build, in the order they are run. ``schema`` is the total
+# time spent in `AsdfSchema.run`, which is part of the ``read`` phase.
+PHASES = ["autogenerate", "read", "schema", "write"]
+
+
+class BuildProfile:
+    """
+    Records the time spent in each phase of a build. When ``trace_memory`` is
+    set the peak memory allocated by Python during each phase is recorded as
+    well, which slows down the build so timings and memory should be measured
+    by separate builds.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.peak_memory = {}
+        self.schemas = 0
+
+    def _timed(self, phase, func, trace=True):
+        def wrapper(*args, **kwargs):
+            trace_memory = trace and self.trace_memory
+            if trace_memory:
+                tracemalloc.reset_peak()
+                start_memory = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.timings[phase] += time.perf_counter() - start
+                if trace_memory:
+                    self.peak_memory[phase] = tracemalloc.get_traced_memory()[1] - start_memory
+
+        return wrapper
+
+    def install(self, monkeypatch):
+        """Instrument sphinx-asdf, this must be done before the app is created"""
+        monkeypatch.setattr(
+            sphinx_asdf, "autogenerate_schema_docs", self._timed("autogenerate", sphinx_asdf.autogenerate_schema_docs)
+        )
+
+        run = self._timed("schema", AsdfSchema.run, trace=False)
+
+        def counted_run(directive):
+            self.schemas += 1
+            return run(directive)
+
+        monkeypatch.setattr(AsdfSchema, "run", counted_run)
+
+    def build(self, make_app, srcdir, **kwargs):
+        """Create an app for ``srcdir`` and run a full build of it"""
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            app = make_app("html", srcdir=srcdir, freshenv=True, **kwargs)
+            app.builder.read = self._timed("read", app.builder.read)
+            app.builder.write = self._timed("write", app.builder.write)
+            app.build()
+        finally:
+            if self.trace_memory:
+                self.peak_memory["total"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        return app
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Description of the environment the benchmarks were run in"""
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        **{package: version(package) for package in ["sphinx_asdf", "sphinx", "docutils", "asdf", "mistune"]},
+    }
+
+
+def write_results(filename, results):
+    with open(filename, "w") as fd:
+        json.dump({"environment": environment(), "benchmarks": results}, fd, indent=2, sort_keys=True)
+        fd.write("\n")
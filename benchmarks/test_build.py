@@ -0,0 +1,53 @@
+"""
+Benchmarks of a full HTML build of synthetic schema corpora.
+
+Run with ``pytest benchmarks/test_build.py -s``. The results are written to
+``benchmark-results.json`` (see ``--benchmark-json``) and two result files
+can be compared with ``python benchmarks/compare.py old.json new.json``.
+"""
+
+import pytest
+from corpus import write_corpus
+from harness import PHASES, BuildProfile
+
+CORPORA = {
+    # Many small schemas
+    "wide": {"schemas": 40, "fanout": 4, "depth": 1},
+    # Few deeply nested schemas
+    "deep": {"schemas": 3, "fanout": 3, "depth": 4},
+    # Schemas made mostly of combiners with large enums
+    "combiners": {"schemas": 10, "combiner_density": 0.6, "enum_size": 50},
+    # Schemas that mostly reference each other
+    "references": {"schemas": 30, "depth": 1, "ref_density": 0.5},
+}
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("name", CORPORA)
+def test_build(make_app, tmp_path, monkeypatch, capsys, benchmark_results, name):
+    corpus = write_corpus(tmp_path / "timings", **CORPORA[name])
+    write_corpus(tmp_path / "memory", **CORPORA[name])
+
+    timings = BuildProfile()
+    with monkeypatch.context() as mp:
+        timings.install(mp)
+        app = timings.build(make_app, tmp_path / "timings")
+    assert timings.schemas == corpus["schemas"]
+
+    # Memory is measured by a separate build since tracing slows it down
+    memory = BuildProfile(trace_memory=True)
+    with monkeypatch.context() as mp:
+        memory.install(mp)
+        memory.build(make_app, tmp_path / "memory")
+
+    benchmark_results[name] = {
+        "corpus": corpus,
+        "documents": len(app.env.all_docs),
+        "timings": timings.timings,
+        "peak_memory": memory.peak_memory,
+    }
+
+    with capsys.disabled():
+        summary = ", ".join(f"{phase} {timings.timings[phase]:.2f} s" for phase in PHASES)
+        peak = memory.peak_memory["total"] / 2**20
+        print(f"\n{name}: {len(app.env.all_docs)} documents: {summary}, peak memory {peak:.1f} MiB")
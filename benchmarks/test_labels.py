@@ -0,0 +1,99 @@
+"""
+Benchmark of the ``doctree-read`` label registration on a large project that
+mixes plain documents with generated schema documents.
+
+Run with ``pytest benchmarks/test_labels.py -s``.
+"""
+
+import os
+import time
+
+import pytest
+from docutils import nodes
+
+import sphinx_asdf
+from sphinx_asdf.connections import normalize_name, traverse
+
+NUM_PLAIN_DOCS = 300
+NUM_SECTIONS = 20
+NUM_SCHEMAS = 10
+NUM_PROPERTIES = 200
+
+
+def legacy_add_labels_to_nodes(app, document, labels, anonlabels):
+    """The label registration as it was before it was limited to schema properties"""
+    basepath = os.path.join("generated", app.env.config.asdf_schema_standard_prefix)
+
+    for node in traverse(document):
+        if isinstance(node, str) or not (isinstance(node, nodes.Node) and node["ids"]):
+            continue
+
+        labelid = node["ids"][0]
+        docname = app.env.docname
+        basename = os.path.relpath(docname, basepath)
+
+        if labelid == normalize_name(basename):
+            name = basename
+        else:
+            name = nodes.fully_normalize_name(basename + ":" + labelid)
+
+        anonlabels[name] = docname, labelid
+        labels[name] = docname, labelid, ""
+
+
+def write_project(srcdir):
+    schema_dir = srcdir / "schemas"
+    schema_dir.mkdir(parents=True)
+    for i in range(NUM_SCHEMAS):
+        lines = ["%YAML 1.1", "---", f"title: Schema {i}", "type: object", "properties:"]
+        for j in range(NUM_PROPERTIES):
+            lines.extend([f"  prop{j}:", f"    title: Property {j}", "    type: string"])
+        lines.append("...")
+        (schema_dir / f"schema{i}.yaml").write_text("\n".join(lines) + "\n")
+
+    docs = []
+    for i in range(NUM_PLAIN_DOCS):
+        lines = [f"Document {i}", "=" * 20, ""]
+        for j in range(NUM_SECTIONS):
+            lines.extend([f".. _doc{i}-target{j}:", "", f"Section {j}", "-" * 20, "", "Some *text*.", ""])
+        (srcdir / f"doc{i}.rst").write_text("\n".join(lines))
+        docs.append(f"doc{i}")
+
+    schemas = "\n".join(f"   schema{i}" for i in range(NUM_SCHEMAS))
+    toctree = "\n".join(f"   {doc}" for doc in docs)
+    (srcdir / "contents.rst").write_text(f".. asdf-autoschemas::\n\n{schemas}\n\n.. toctree::\n\n{toctree}\n")
+    (srcdir / "conf.py").write_text('extensions = ["sphinx_asdf"]\nmaster_doc = "contents"\n')
+
+
+@pytest.mark.benchmark
+def test_label_registration(make_app, tmp_path, monkeypatch, capsys):
+    srcdir = tmp_path / "mixed"
+    write_project(srcdir)
+
+    timings = {"current": 0.0, "legacy": 0.0}
+    add_labels_to_nodes = sphinx_asdf.add_labels_to_nodes
+
+    def timed_add_labels_to_nodes(app, document):
+        start = time.perf_counter()
+        add_labels_to_nodes(app, document)
+        timings["current"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        legacy_add_labels_to_nodes(app, document, {}, {})
+        timings["legacy"] += time.perf_counter() - start
+
+    monkeypatch.setattr(sphinx_asdf, "add_labels_to_nodes", timed_add_labels_to_nodes)
+
+    app = make_app("dummy", srcdir=srcdir)
+    app.build()
+
+    with capsys.disabled():
+        print(
+            f"\ndoctree-read label registration for {len(app.env.all_docs)} documents: "
+            f"{timings['current'] * 1000:.1f} ms (legacy full walk: {timings['legacy'] * 1000:.1f} ms, "
+            f"{timings['legacy'] / timings['current']:.1f}x)"
+        )
+
+    labels = app.env.domaindata["std"]["labels"]
+    assert all(f"schema{i}:prop{j}" in labels for i in range(NUM_SCHEMAS) for j in range(NUM_PROPERTIES))
+    assert timings["current"] < timings["legacy"]
@@ -1,11 +1,26 @@
-from .asdf2rst import AsdfDirective, RunCodeDirective
+from sphinx.config import ENUM
+
+from .asdf2rst import AsdfDirective, RunCodeDirective, prune_asdf_cache, prune_runcode_cache
+from .cache import stamp_caches
+from .compact import UnpackSchemaDocs, pack_schema_docs
 from .connections import (
     add_labels_to_nodes,
     autogenerate_schema_docs,
+    find_referencing_docs,
     update_app_config,
 )
-from .directives import AsdfAutoschemas, AsdfSchema
+from .directives import AsdfAutoschemas, AsdfSchema, prune_doctree_cache
+from .envdata import merge_doc_data, purge_doc_data
+from .examples import prune_example_cache, validate_schema_examples
+from .expansion import clear_expansions
+from .fastpath import schema_html
+from .highlight import cache_highlighting, prune_highlighting
+from .lazy import add_lazy_script, defer_schema_sections, lazy_section, prune_lazy_sections, stamp_lazy_sections
 from .nodes import add_asdf_nodes
+from .profiling import record_doctree_size, reset_profile, write_profile_report
+from .references import REFERENCE_MAPPING_MATCHES, compile_reference_mappings
+from .runcode import close_runner, close_worker_pool
+from .search import add_search_script, exclude_from_search, write_search_index
 
 
 def setup(app):
@@ -13,6 +28,47 @@ def setup(app):
     app.add_config_value("asdf_schema_path", "schemas", "env")
     app.add_config_value("asdf_schema_standard_prefix", "", "env")
     app.add_config_value("asdf_schema_reference_mappings", [], "env")
+    # Which mapping is used when several match a reference, the "first" one
+    # listed or the one with the "longest" prefix
+    app.add_config_value("asdf_schema_reference_mapping_match", "first", "env", types=ENUM(*REFERENCE_MAPPING_MATCHES))
+    # Parse all markdown in a schema with a single nested parse
+    app.add_config_value("asdf_schema_batch_markdown", True, "env")
+    # Reuse the documentation rendered for unchanged schemas in previous builds
+    app.add_config_value("asdf_schema_doctree_cache", True, "env")
+    # Render the schema documentation to HTML while documents are read
+    app.add_config_value("asdf_schema_html_fast_path", False, "env")
+    # Store the schema documentation compressed in the doctrees
+    app.add_config_value("asdf_schema_compact_doctrees", False, "env")
+    # Load the properties nested deeper than this many levels (0 for none),
+    # and the original YAML of the schemas, from separate files in HTML output
+    app.add_config_value("asdf_schema_lazy_depth", 0, "html")
+    app.add_config_value("asdf_schema_lazy_original", False, "html")
+    # Write a compact index of the schema properties for the search page, and
+    # keep the schema documentation out of the general search index
+    app.add_config_value("asdf_schema_search_index", True, "html")
+    app.add_config_value("asdf_schema_exclude_from_search", False, "html")
+    # Validate the examples of the schemas with asdf, using this many worker
+    # processes ("auto" uses the number given to sphinx-build -j)
+    app.add_config_value("asdf_schema_validate_examples", False, "env")
+    app.add_config_value("asdf_schema_validation_workers", 0, "", types=(int, str))
+    # Reuse the highlighted YAML of literal blocks written by previous builds
+    app.add_config_value("asdf_highlight_cache", True, "")
+    # Number of worker processes used to discover asdf-autoschemas directives,
+    # "auto" uses the number given to sphinx-build -j, 0 disables it
+    app.add_config_value("asdf_schema_discovery_workers", 0, "", types=(int, str))
+    # Restore the files written by runcode blocks that were executed by
+    # previous builds instead of executing them again
+    app.add_config_value("asdf_runcode_cache", True, "env")
+    # Number of idle worker processes kept ready to execute the runcode blocks
+    # of a document, 0 executes them in the Sphinx process
+    app.add_config_value("asdf_runcode_workers", 0, "")
+    # Limits of each runcode block (in seconds) and of the address space of
+    # each worker process (in bytes), 0 for no limit
+    app.add_config_value("asdf_runcode_timeout", 0, "")
+    app.add_config_value("asdf_runcode_memory_limit", 0, "")
+    # Write a report of the time spent in each directive, True or the name of
+    # the report relative to the output directory
+    app.add_config_value("asdf_profile", False, "", types=(bool, str))
 
     app.add_directive("asdf-autoschemas", AsdfAutoschemas)
     app.add_directive("asdf-schema", AsdfSchema)
@@ -20,9 +76,39 @@ def setup(app):
     app.add_directive("asdf", AsdfDirective)
 
     add_asdf_nodes(app)
+    app.add_post_transform(UnpackSchemaDocs)
+    app.add_node(schema_html, html=(schema_html.visit_html, schema_html.depart_html))
+    app.add_node(lazy_section, html=(lazy_section.visit_html, lazy_section.depart_html))
 
+    app.connect("builder-inited", reset_profile)
+    app.connect("builder-inited", clear_expansions)
     app.connect("builder-inited", autogenerate_schema_docs)
+    app.connect("builder-inited", add_lazy_script)
+    app.connect("builder-inited", cache_highlighting)
     app.connect("config-inited", update_app_config)
+    app.connect("config-inited", compile_reference_mappings)
     app.connect("doctree-read", add_labels_to_nodes)
+    app.connect("doctree-read", close_runner)
+    # After everything else has seen the nodes of the schema documentation
+    app.connect("doctree-read", pack_schema_docs, priority=900)
+    app.connect("doctree-read", record_doctree_size, priority=950)
+    app.connect("doctree-resolved", exclude_from_search)
+    app.connect("doctree-resolved", defer_schema_sections)
+    app.connect("html-page-context", add_search_script)
+    app.connect("html-collect-pages", write_search_index)
+    app.connect("env-get-outdated", find_referencing_docs)
+    app.connect("env-before-read-docs", stamp_caches)
+    app.connect("env-purge-doc", purge_doc_data)
+    app.connect("env-merge-info", merge_doc_data)
+    app.connect("env-updated", validate_schema_examples)
+    app.connect("env-updated", stamp_lazy_sections)
+    app.connect("build-finished", write_profile_report)
+    app.connect("build-finished", close_worker_pool)
+    app.connect("build-finished", prune_doctree_cache)
+    app.connect("build-finished", prune_runcode_cache)
+    app.connect("build-finished", prune_asdf_cache)
+    app.connect("build-finished", prune_highlighting)
+    app.connect("build-finished", prune_example_cache)
+    app.connect("build-finished", prune_lazy_sections)
 
     return dict(version="0.1.1", parallel_read_safe=True, parallel_write_safe=True)
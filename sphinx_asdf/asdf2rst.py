@@ -1,8 +1,10 @@
 import codecs
-import io
 import os
+import shutil
+import sys
 import tempfile
 import textwrap
+from urllib.parse import quote
 
 import asdf
 from asdf.constants import BLOCK_FLAG_STREAMED
@@ -10,33 +12,157 @@ from docutils import nodes
 from docutils.parsers.rst import Directive
 from sphinx.util.nodes import set_source_info
 
+from .blocks import BlockReader
+from .cache import DiskCache, cache_path, content_hash, file_hash, prune_cache, sphinx_asdf_version
+from .profiling import profiled
+from .runcode import RunCodeError, create_runner
+
 TMPDIR = tempfile.mkdtemp()
-GLOBALS = {}
 FLAGS = {BLOCK_FLAG_STREAMED: "BLOCK_FLAG_STREAMED"}
+# Number of bytes of the data of each block that are shown
+BLOCK_PREVIEW_SIZE = 20
+
+# Version of the cached output of the asdf directive (see cache.py)
+ASDF_CACHE_VERSION = 1
+
+# The rendered output of the asdf directive, keyed by the content of the file
+# and the arguments of the directive
+_asdf_outputs = {}
+# path -> (size, modification time, content hash) of the files described
+_asdf_signatures = {}
+
+# Version of the runcode cache (see cache.py)
+RUNCODE_CACHE_VERSION = 1
+
+
+def document_tmpdir(env):
+    """
+    The working directory of the runcode and asdf directives of the document
+    being read. Each document gets its own directory so that documents read
+    in parallel can't overwrite each other's files. The directories are all
+    directly in `TMPDIR`, as the directory of a document must not contain the
+    ones of the documents below it (which starting the document clears).
+    """
+    path = os.path.join(TMPDIR, quote(env.docname, safe=""))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def document_runcode(env):
+    """
+    The state shared by all runcode blocks of the document being read: the
+    runner holding the namespace of the blocks (only created once a block
+    needs to be executed, see `document_runner`), the cache key of the last
+    block and the code of the blocks that were restored from the cache instead
+    of being executed. It only lives as long as the document is being read, so
+    documents can't depend on each other (which would break when reading
+    them in parallel).
+    """
+    state = env.temp_data.get("runcode")
+    if state is None:
+        # Start every document from an empty working directory
+        tmpdir = document_tmpdir(env)
+        shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        state = env.temp_data["runcode"] = {"runner": None, "key": "", "skipped": []}
+    return state
+
+
+def document_runner(env):
+    """
+    The runner of the runcode blocks of the document being read. Documents
+    whose blocks are all restored from the cache never start one (which, with
+    ``asdf_runcode_workers``, forks a worker process).
+    """
+    state = document_runcode(env)
+    if state["runner"] is None:
+        state["runner"] = create_runner(env, document_tmpdir(env))
+    return state["runner"]
+
+
+def _snapshot(path):
+    """The size and modification time of all files in a directory"""
+    files = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            stat = os.stat(filename)
+            files[os.path.relpath(filename, path)] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def _read_files(path, filenames):
+    files = {}
+    for filename in filenames:
+        with open(os.path.join(path, filename), "rb") as fd:
+            files[filename] = fd.read()
+    return files
+
+
+def _restore_files(path, entry):
+    for filename in entry["removed"]:
+        try:
+            os.remove(os.path.join(path, filename))
+        except FileNotFoundError:
+            pass
+    for filename, data in entry["files"].items():
+        filename = os.path.join(path, filename)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as fd:
+            fd.write(data)
 
 
 class RunCodeDirective(Directive):
     has_content = True
     optional_arguments = 1
 
+    def _exec(self, runner, code):
+        try:
+            runner.run(code)
+        except RunCodeError as err:
+            raise self.error(f"runcode block failed:\n{err}") from None
+
     def run(self):
+        with profiled(self.state.document.settings.env, "runcode", f"line {self.lineno}"):
+            return self._run()
+
+    def _run(self):
         code = textwrap.dedent("\n".join(self.content))
+        env = self.state.document.settings.env
+        state = document_runcode(env)
+        tmpdir = document_tmpdir(env)
 
-        cwd = os.getcwd()
-        os.chdir(TMPDIR)
+        # The blocks of a document share their namespace, so the result of a
+        # block depends on all of the blocks before it
+        state["key"] = content_hash(
+            repr((RUNCODE_CACHE_VERSION, sys.version, asdf.__version__, state["key"], code)).encode("utf-8")
+        )
+        cache = DiskCache(cache_path(env, "runcode")) if env.config.asdf_runcode_cache else None
 
-        try:
-            try:
-                exec(code, GLOBALS)  # noqa: S102
-            except Exception:
-                print(code)
-                raise
+        entry = cache.get(state["key"]) if cache is not None else None
+        if isinstance(entry, dict):
+            _restore_files(tmpdir, entry)
+            state["skipped"].append(code)
+        else:
+            # Blocks restored from the cache are executed after all once a
+            # later block needs the namespace they would have created
+            runner = document_runner(env)
+            for skipped in state["skipped"]:
+                self._exec(runner, skipped)
+            state["skipped"] = []
 
-            literal = nodes.literal_block(code, code)
-            literal["language"] = "python"
-            set_source_info(self, literal)
-        finally:
-            os.chdir(cwd)
+            before = _snapshot(tmpdir)
+            self._exec(runner, code)
+            after = _snapshot(tmpdir)
+
+            if cache is not None:
+                changed = [filename for filename, stat in after.items() if before.get(filename) != stat]
+                removed = [filename for filename in before if filename not in after]
+                cache.set(state["key"], {"files": _read_files(tmpdir, changed), "removed": removed})
+
+        literal = nodes.literal_block(code, code)
+        literal["language"] = "python"
+        set_source_info(self, literal)
 
         if "hidden" not in self.arguments:
             return [literal]
@@ -44,26 +170,20 @@ class RunCodeDirective(Directive):
             return []
 
 
-def _block_to_string(block):
-    if hasattr(block, "header"):
-        header = block.header
-        data = block.data
-    else:
-        data = block.data
-        header = {
-            "flags": block._flags,
-            "allocated_size": block._allocated,
-            "used_size": block._size,
-            "data_size": block._data_size,
-            "compression": block.input_compression,
-        }
+def prune_runcode_cache(app, exception):
+    if exception is None and app.config.asdf_runcode_cache:
+        prune_cache(app.env, "runcode")
+
+
+def _block_to_string(header, data):
+    header = dict(header)
     if header["flags"] & BLOCK_FLAG_STREAMED:
         header["allocated"] = header["used_size"] = header["data_size"] = 0
 
     # convert data to hex representation
-    data = codecs.encode(data.tobytes(), "hex")
-    if len(data) > 40:
-        data = data[:40] + b"..."
+    data = codecs.encode(data, "hex")
+    if len(data) > BLOCK_PREVIEW_SIZE * 2:
+        data = data[: BLOCK_PREVIEW_SIZE * 2] + b"..."
 
     lines = []
 
@@ -88,78 +208,76 @@ def _block_to_string(block):
     return code
 
 
+def _file_digest(path):
+    """The content hash of a file, only computed again once the file changed"""
+    stat = os.stat(path)
+    signature = _asdf_signatures.get(path)
+    if signature is None or signature[:2] != (stat.st_size, stat.st_mtime_ns):
+        signature = _asdf_signatures[path] = (stat.st_size, stat.st_mtime_ns, file_hash(path))
+    return signature[2]
+
+
 class AsdfDirective(Directive):
     required_arguments = 1
     optional_arguments = 1
 
     def run(self):
-        filename = self.arguments[0]
+        with profiled(self.state.document.settings.env, "asdf", self.arguments[0]):
+            return self._run()
+
+    def _describe(self, path, show_header, show_blocks):
+        """The text of the YAML header, of each block and of the block index"""
+        codes = []
+        # Read one more byte of each block than is shown to tell if there's more
+        with BlockReader(path, BLOCK_PREVIEW_SIZE + 1) as reader:
+            if show_header:
+                header = reader.yaml_header()
+                if header is None:
+                    raise self.error(f"{self.arguments[0]} has no end of YAML marker")
+                codes.append(header.decode("utf-8") + "\n")
+
+            if show_blocks:
+                blocks = list(reader.blocks())
+
+                for i, block in enumerate(blocks):
+                    codes.append("\n".join([f"BLOCK {i}:", _block_to_string(block.header, block.data), ""]))
 
-        cwd = os.getcwd()
-        os.chdir(TMPDIR)
+                # re-write out the block index
+                if len(blocks) and not blocks[-1].header["flags"] & BLOCK_FLAG_STREAMED:
+                    block_index = reader.block_index(blocks[-1].end)
+                    if block_index is not None:
+                        codes.append(block_index.decode("utf-8"))
+        return codes
+
+    def _run(self):
+        filename = self.arguments[0]
+        path = os.path.join(document_tmpdir(self.state.document.settings.env), filename)
 
         show_header = "no_header" not in self.arguments
         show_bocks = "no_blocks" not in self.arguments
 
+        # The file is missing when the runcode block that writes it failed
+        if not os.path.exists(path):
+            raise self.error(f"{filename} does not exist")
+
+        key = repr((ASDF_CACHE_VERSION, sphinx_asdf_version(), _file_digest(path), tuple(self.arguments[1:])))
+        cache = DiskCache(cache_path(self.state.document.settings.env, "asdf"))
+        codes = _asdf_outputs.get(key)
+        if codes is not None:
+            cache.touch(key)
+        else:
+            codes = cache.get(key)
+            if not isinstance(codes, list):
+                codes = self._describe(path, show_header, show_bocks)
+                cache.set(key, codes)
+            _asdf_outputs[key] = codes
+
         parts = []
-        try:
-            if show_header:
-                with asdf.generic_io.get_file(filename, "r") as gf:
-                    reader = gf.reader_until(
-                        asdf.constants.YAML_END_MARKER_REGEX,
-                        7,
-                        "End of YAML marker",
-                        include=True,
-                    )
-                    code = reader.read().decode("utf-8") + "\n"
-                    literal = nodes.literal_block(code, code)
-                    literal["language"] = "yaml"
-                    set_source_info(self, literal)
-                    parts.append(literal)
-
-            kwargs = dict()
-            # Use the ignore_unrecognized_tag parameter as a proxy for both options
-            kwargs["ignore_unrecognized_tag"] = "ignore_unrecognized_tag" in self.arguments
-            kwargs["ignore_missing_extensions"] = "ignore_unrecognized_tag" in self.arguments
-
-            if show_bocks:
-                with asdf.open(filename, **kwargs) as ff:
-                    if hasattr(ff._blocks, "internal_blocks"):
-                        blocks = list(ff._blocks.internal_blocks)
-                    else:
-                        blocks = ff._blocks.blocks
-
-                    for i, block in enumerate(blocks):
-                        code = "\n".join([f"BLOCK {i}:", _block_to_string(block), ""])
-                        literal = nodes.literal_block(code, code)
-                        literal["language"] = "yaml"
-                        set_source_info(self, literal)
-                        parts.append(literal)
-
-                    # re-write out the block index
-                    if len(blocks):
-                        if hasattr(blocks[-1], "header"):
-                            streamed = blocks[-1].header["flags"] & BLOCK_FLAG_STREAMED
-                        else:
-                            streamed = blocks[-1].array_storage == "streamed"
-                        if not streamed:
-                            # write out the block index
-                            if hasattr(blocks[0], "header"):
-                                block_index_offset = asdf._block.io.find_block_index(ff._fd)
-                                buff = io.BytesIO()
-                                ff._fd.seek(block_index_offset)
-                                buff = io.BytesIO(ff._fd.read())
-                            else:
-                                buff = io.BytesIO()
-                                ff._blocks.write_block_index(buff, ff)
-
-                            block_index = buff.getvalue().decode("utf-8")
-                            literal = nodes.literal_block(block_index, block_index)
-                            literal["language"] = "yaml"
-                            set_source_info(self, literal)
-                            parts.append(literal)
-        finally:
-            os.chdir(cwd)
+        for code in codes:
+            literal = nodes.literal_block(code, code)
+            literal["language"] = "yaml"
+            set_source_info(self, literal)
+            parts.append(literal)
 
         result = nodes.admonition()
         textnodes, messages = self.state.inline_text(filename, self.lineno)
@@ -167,3 +285,8 @@ class AsdfDirective(Directive):
         result += title
         result += parts
         return [result]
+
+
+def prune_asdf_cache(app, exception):
+    if exception is None:
+        prune_cache(app.env, "asdf")
@@ -0,0 +1,151 @@
+"""
+A reader of the layout of ASDF files that is used to describe their binary
+blocks. The file is memory-mapped and only the block headers, the block
+index and the leading bytes of each block are read, so that describing the
+blocks of a large file doesn't require loading (or decompressing) all of
+its data.
+"""
+
+import bz2
+import mmap
+import re
+import struct
+import zlib
+
+import asdf
+from asdf.constants import BLOCK_FLAG_STREAMED, BLOCK_MAGIC, INDEX_HEADER, YAML_END_MARKER_REGEX
+
+# The size of the block header, which follows the magic
+BLOCK_HEADER_SIZE = struct.Struct(">H")
+# flags, compression, allocated_size, used_size, data_size, checksum
+BLOCK_HEADER = struct.Struct(">I4sQQQ16s")
+
+# Size of the chunks of compressed data fed to the decompressors
+CHUNK_SIZE = 64 * 1024
+
+
+class AsdfBlock:
+    """
+    The header of a block, along with the first ``preview_size`` bytes of its
+    (decompressed) data.
+    """
+
+    __slots__ = ("data", "end", "header", "offset")
+
+    def __init__(self, offset, end, header, data):
+        self.offset = offset
+        self.end = end
+        self.header = header
+        self.data = data
+
+
+class BlockReader:
+    def __init__(self, filename, preview_size):
+        self.preview_size = preview_size
+        with open(filename, "rb") as fd:
+            try:
+                self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                self._map = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+
+    def yaml_header(self):
+        """The start of the file up to the end of the YAML tree, or `None`"""
+        match = re.search(YAML_END_MARKER_REGEX, self._map)
+        if match is None:
+            return None
+        return self._map[: match.end()]
+
+    def blocks(self):
+        """Iterate over the blocks that follow the YAML tree"""
+        match = re.search(YAML_END_MARKER_REGEX, self._map)
+        offset = self._map.find(BLOCK_MAGIC, match.end() if match else 0)
+        size = len(self._map)
+
+        while offset != -1 and self._map[offset : offset + len(BLOCK_MAGIC)] == BLOCK_MAGIC:
+            start = offset + len(BLOCK_MAGIC)
+            (header_size,) = BLOCK_HEADER_SIZE.unpack_from(self._map, start)
+            if header_size < BLOCK_HEADER.size:
+                msg = f"Block header size must be >= {BLOCK_HEADER.size}"
+                raise ValueError(msg)
+            fields = BLOCK_HEADER.unpack_from(self._map, start + BLOCK_HEADER_SIZE.size)
+            header = dict(zip(["flags", "compression", "allocated_size", "used_size", "data_size", "checksum"], fields))
+
+            data_start = start + BLOCK_HEADER_SIZE.size + header_size
+            used_size = header["used_size"]
+            streamed = header["flags"] & BLOCK_FLAG_STREAMED
+            if streamed:
+                # The data of a streamed block extends to the end of the file
+                used_size = size - data_start
+            end = data_start + (used_size if streamed else header["allocated_size"])
+
+            yield AsdfBlock(offset, end, header, self._preview(data_start, used_size, header))
+
+            if streamed:
+                return
+            offset = end
+
+    def block_index(self, end):
+        """The text of the block index after offset ``end``, or `None`"""
+        index = self._map.rfind(INDEX_HEADER, end)
+        if index == -1:
+            return None
+        return self._map[index:]
+
+    def _preview(self, start, size, header):
+        compression = header["compression"].rstrip(b"\0").decode("ascii")
+        if not compression:
+            return self._map[start : start + min(size, self.preview_size)]
+        if compression == "zlib":
+            return self._decompress_chunks(start, size, zlib.decompressobj().decompress)
+        if compression == "bzp2":
+            return self._decompress_chunks(start, size, bz2.BZ2Decompressor().decompress)
+        if compression == "lz4":
+            return self._decompress_lz4(start, size)
+        return self._decompress_extension(start, size, compression, header["data_size"])
+
+    def _decompress_chunks(self, start, size, decompress):
+        preview = b""
+        for offset in range(start, start + size, CHUNK_SIZE):
+            # A single chunk of highly compressible data can decompress to
+            # many megabytes, so only the missing part of the preview is
+            # decompressed
+            preview += decompress(
+                self._map[offset : min(offset + CHUNK_SIZE, start + size)], self.preview_size - len(preview)
+            )
+            if len(preview) >= self.preview_size:
+                break
+        return preview
+
+    def _decompress_lz4(self, start, size):
+        import lz4.block
+
+        # The data is a series of lz4 blocks, each preceded by its size
+        preview = b""
+        offset = start
+        while offset < start + size and len(preview) < self.preview_size:
+            (block_size,) = struct.unpack_from("!I", self._map, offset)
+            preview += lz4.block.decompress(self._map[offset + 4 : offset + 4 + block_size])
+            offset += 4 + block_size
+        return preview[: self.preview_size]
+
+    def _decompress_extension(self, start, size, compression, data_size):
+        # Compressors provided by extensions can only decompress all of the data
+        for extension in asdf.get_config().extensions:
+            for compressor in extension.compressors:
+                if compressor.label.decode("ascii") == compression:
+                    out = bytearray(data_size)
+                    compressor.decompress(iter([self._map[start : start + size]]), out)
+                    return bytes(out[: self.preview_size])
+        msg = f"Unknown compression type: {compression!r}"
+        raise ValueError(msg)
@@ -0,0 +1,195 @@
+"""
+Helpers for the on-disk caches that sphinx-asdf keeps next to the doctree
+pickles written by Sphinx.
+"""
+
+import functools
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+from importlib.metadata import version
+
+from docutils import nodes
+
+CACHE_DIRNAME = "sphinx_asdf"
+
+# Each cache keys its entries by everything they depend on, including a
+# ``*_CACHE_VERSION`` constant of its own. Bump the version of a cache whenever
+# its entries change in a way that the rest of the key doesn't reflect (e.g.
+# during development). Entries of older versions are then no longer used, and
+# `prune_cache` removes them.
+
+# Marks the start of a build that reads every document
+CACHE_STAMP = "build.stamp"
+
+
+def cache_path(env, *names):
+    """Path to a cache file or directory inside of the doctree directory"""
+    return os.path.join(env.doctreedir, CACHE_DIRNAME, *names)
+
+
+@functools.cache
+def sphinx_asdf_version():
+    return version("sphinx_asdf")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_MISSING = object()
+
+
+def load_pickle(filename, default=None):
+    """
+    Load a pickled cache file. A missing, truncated or otherwise unreadable
+    cache is never an error, the default is returned instead.
+    """
+    try:
+        with open(filename, "rb") as fd:
+            return pickle.load(fd)  # noqa: S301
+    except Exception:
+        return default
+
+
+@contextmanager
+def atomic_write(filename):
+    """
+    Open a file for writing that only replaces ``filename`` once it is
+    complete, so that an interrupted build (or a concurrent one) never leaves
+    a partially written file behind.
+    """
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as ff:
+            yield ff
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def dump_pickle(filename, obj):
+    """Atomically write a pickled cache file"""
+    with atomic_write(filename) as ff:
+        pickle.dump(obj, ff, pickle.HIGHEST_PROTOCOL)
+
+
+class DiskCache:
+    """
+    A directory of pickled cache entries. Each key is hashed to give the
+    name of the file the entry is stored in.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        digest = content_hash(key.encode("utf-8"))
+        return os.path.join(self.directory, digest[:2], digest + ".pickle")
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        value = load_pickle(path, _MISSING)
+        if value is _MISSING:
+            return default
+        self._touch(path)
+        return value
+
+    def set(self, key, value):
+        dump_pickle(self._path(key), value)
+
+    def touch(self, key):
+        """Mark an entry that was used without `get` as used"""
+        self._touch(self._path(key))
+
+    @staticmethod
+    def _touch(path):
+        # Entries used by a build are kept by `prune_cache`
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def prune(self, since):
+        """Remove the entries that were last used before ``since`` (in ns)"""
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(path).st_mtime_ns < since:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+def stamp_caches(app, env, docnames):
+    """
+    Record the start of a build that reads every document, so that the cache
+    entries it doesn't use can be removed once it is done.
+    """
+    env.asdf_cache_stamp = None
+    if env.found_docs <= set(docnames):
+        stamp = cache_path(env, CACHE_STAMP)
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp, "wb"):
+            pass
+        env.asdf_cache_stamp = os.stat(stamp).st_mtime_ns
+
+
+def prune_cache(env, *names):
+    """
+    Remove the entries of a `DiskCache` that were not used by a build that
+    read every document, such as the ones of changed documents, schemas and
+    versions. Incremental builds only use the entries of the documents they
+    read, so they keep all of them.
+    """
+    since = getattr(env, "asdf_cache_stamp", None)
+    if since is not None:
+        DiskCache(cache_path(env, *names)).prune(since)
+
+
+class _NodePickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        # The document is replaced by the one the nodes are loaded into
+        if isinstance(obj, nodes.document):
+            return "document"
+        return None
+
+
+class _NodeUnpickler(pickle.Unpickler):
+    def __init__(self, file, document):
+        super().__init__(file)
+        self.document = document
+
+    def persistent_load(self, pid):
+        if pid == "document":
+            return self.document
+        raise pickle.UnpicklingError(f"unsupported persistent id {pid!r}")
+
+
+def dumps_nodes(obj):
+    """
+    Pickle a docutils subtree without the document it belongs to, so that it
+    can be loaded into a different document with `loads_nodes`.
+    """
+    buff = io.BytesIO()
+    _NodePickler(buff, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return buff.getvalue()
+
+
+def loads_nodes(data, document):
+    return _NodeUnpickler(io.BytesIO(data), document).load()
@@ -0,0 +1,45 @@
+"""
+A compact representation of the schema documentation in the doctrees.
+
+With ``asdf_schema_compact_doctrees`` the nodes of each schema document are
+pickled and compressed into a single node once the document has been read
+(and transformed), and restored when the document is resolved for writing,
+before any of the references in it are resolved.
+The doctrees stored in the environment (which every reader process and
+every incremental build loads) are then a fraction of their size, at the
+cost of unpacking each schema document once when it is written.
+"""
+
+import zlib
+
+from docutils import nodes
+from sphinx.transforms.post_transforms import ReferencesResolver, SphinxPostTransform
+
+from .cache import dumps_nodes, loads_nodes
+from .directives import AsdfSchema
+from .fastpath import schema_html
+from .nodes import schema_doc
+
+
+class packed_schema_doc(nodes.Element):
+    """The compressed pickle of the nodes of a schema document"""
+
+
+def pack_schema_docs(app, doctree):
+    if not app.config.asdf_schema_compact_doctrees:
+        return
+    for node in list(doctree.findall(lambda node: isinstance(node, (schema_doc, schema_html)))):
+        # Nodes registered with the document need to stay where they are
+        if AsdfSchema._is_cacheable(node):
+            node.replace_self(packed_schema_doc(data=zlib.compress(dumps_nodes(node))))
+
+
+class UnpackSchemaDocs(SphinxPostTransform):
+    """Restore the packed schema documentation of a document"""
+
+    # The references in the schema documentation need to be resolved
+    default_priority = ReferencesResolver.default_priority - 5
+
+    def run(self, **kwargs):
+        for node in list(self.document.findall(packed_schema_doc)):
+            node.replace_self(loads_nodes(zlib.decompress(node["data"]), self.document))
@@ -1,6 +1,7 @@
 import logging
 import os
 import posixpath
+import re
 
 import docutils
 import packaging.version
@@ -8,8 +9,13 @@ import sphinx.builders
 from docutils import nodes
 from sphinx.util import rst
 from sphinx.util.docutils import sphinx_domains
+from sphinx.util.parallel import ParallelTasks, make_chunks
 
+from .cache import cache_path, dump_pickle, file_hash, load_pickle, sphinx_asdf_version
 from .directives import schema_def
+from .envdata import doc_data
+from .parallel import worker_count
+from .profiling import build_timer
 
 # docutils 0.19.0 fixed a bug in traverse/findall
 # https://sourceforge.net/p/docutils/bugs/448/
@@ -28,6 +34,30 @@ else:
         return doctree.traverse(*args, **kwargs)
 
 
+# Matches the start of an ``asdf-autoschemas`` directive. ``include`` directives
+# are matched as well since the included file may contain the directive. Like
+# docutils, directive names are matched regardless of their case.
+AUTOSCHEMAS_PATTERN = re.compile(
+    rb"^[ \t]*\.\.[ \t]+(?:asdf-autoschemas|include)[ \t]*::", re.MULTILINE | re.IGNORECASE
+)
+
+
+def may_contain_autoschemas(filename):
+    """
+    Cheaply determine if a source file could contain an ``asdf-autoschemas``
+    directive without parsing it. Files that can't be read are reported as
+    candidates so that the full parse reports the error.
+    """
+    if filename.endswith(".md"):
+        return False
+
+    try:
+        with open(filename, "rb") as fd:
+            return AUTOSCHEMAS_PATTERN.search(fd.read()) is not None
+    except OSError:
+        return True
+
+
 def find_autoasdf_directives(app, env, filename):
     if filename.endswith(".md"):
         return []
@@ -46,6 +76,79 @@ def find_autoasdf_directives(app, env, filename):
     return traverse(doctree, schema_def)
 
 
+def _read_schema_references(app, paths):
+    """
+    Fully parse each of the given files and return a list of ``(path, refs,
+    deps)`` tuples where ``refs`` describes each schema listed by an
+    ``asdf-autoschemas`` directive as a ``(schema_name, schema_root,
+    standard_prefix)`` tuple and ``deps`` lists the files (e.g. includes) read
+    while parsing. Tuples are used instead of the `schema_def` nodes so that
+    the result can be sent back from a worker process.
+    """
+    results = []
+    for path in paths:
+        docname = app.env.path2doc(path)
+        app.env.temp_data["docname"] = docname
+        refs = [
+            (schema.children[0].astext(), schema.schema_root, schema.standard_prefix)
+            for schema in find_autoasdf_directives(app, app.env, path)
+        ]
+        deps = [os.path.join(app.env.srcdir, dep) for dep in app.env.dependencies.get(docname, ())]
+        results.append((path, refs, deps))
+    return results
+
+
+# Version of the discovery cache (see cache.py)
+DISCOVERY_CACHE_VERSION = 1
+
+
+def _file_signature(path):
+    """The ``(mtime, content hash)`` pair used to detect changed files"""
+    return os.stat(path).st_mtime_ns, file_hash(path)
+
+
+def _is_unchanged(path, signature):
+    """
+    Check a file against a stored signature. The content hash is only
+    computed when the modification time differs, and a matching hash
+    refreshes the stored modification time.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if mtime == signature[0]:
+            return True
+        if file_hash(path) == signature[1]:
+            signature[0] = mtime
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def _load_discovery_cache(app):
+    """
+    Load the cache mapping each source file to the schema references found in
+    it during previous builds. The cache is discarded when it was written by
+    a different version of the cache layout or when any of the configuration
+    values that determine the references changed.
+    """
+    key = (DISCOVERY_CACHE_VERSION, app.config.asdf_schema_path, app.config.asdf_schema_standard_prefix)
+    cache = load_pickle(cache_path(app.env, "discovery.pickle"))
+    if not isinstance(cache, dict) or cache.get("key") != key:
+        cache = {"key": key, "files": {}}
+    return cache
+
+
+def _discovery_cache_entry(path, refs, deps=()):
+    signatures = {}
+    for dep in [path, *deps]:
+        try:
+            signatures[dep] = list(_file_signature(dep))
+        except OSError:
+            continue
+    return {"refs": refs, "signatures": signatures}
+
+
 def find_autoschema_references(app, genfiles):
     # We set this environment variable to indicate that the AsdfSchemas
     # directive should be parsed as a simple list of schema references
@@ -57,42 +160,125 @@ def find_autoschema_references(app, genfiles):
     orig_level = logger.getEffectiveLevel()
     logger.setLevel(logging.ERROR)
 
-    schemas = set()
+    cache = _load_discovery_cache(app)
+    entries = {}
+    paths = []
     for fn in genfiles:
-        # Create documentation files based on contents of asdf-schema directives
         path = posixpath.join(app.env.srcdir, fn)
-        app.env.temp_data["docname"] = app.env.path2doc(path)
-        schemas = schemas.union(find_autoasdf_directives(app, app.env, path))
+        entry = cache["files"].get(path)
+        if (
+            entry is not None
+            and entry["signatures"]
+            and all(_is_unchanged(dep, signature) for dep, signature in entry["signatures"].items())
+        ):
+            entries[path] = entry
+        # Only fully parse the files that may contain the directive
+        elif may_contain_autoschemas(path):
+            paths.append(path)
+        else:
+            entries[path] = _discovery_cache_entry(path, [])
+
+    results = []
+    nproc = worker_count(app, app.config.asdf_schema_discovery_workers)
+    if nproc > 1 and len(paths) > 1:
+        # Each worker reads a chunk of the files in a forked copy of the
+        # environment, only the schema references are sent back.
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(paths, nproc):
+            tasks.add_task(
+                lambda chunk: _read_schema_references(app, chunk),
+                chunk,
+                lambda chunk, result: results.extend(result),
+            )
+        tasks.join()
+    else:
+        results = _read_schema_references(app, paths)
 
     logger.setLevel(orig_level)
 
     # Unset this variable now that we're done.
     app.env.autoasdf_generate = False
 
-    return list(schemas)
+    for path, refs, deps in results:
+        entries[path] = _discovery_cache_entry(path, refs, deps)
+    cache["files"] = entries
+    dump_pickle(cache_path(app.env, "discovery.pickle"), cache)
+
+    refs = sorted({tuple(ref) for entry in entries.values() for ref in entry["refs"]})
+    return [
+        schema_def(text=schema_name, schema_root=schema_root, standard_prefix=standard_prefix)
+        for schema_name, schema_root, standard_prefix in refs
+    ]
+
+
+def render_schema_doc(schema_name, schema_root, standard_prefix):
+    """Render the contents of the generated document for a single schema"""
+    lines = [
+        f".. _{standard_prefix}/{schema_name}:",
+        "",
+        schema_name,
+        "=" * len(schema_name),
+        "",
+        ".. asdf-schema::",
+    ]
+    if standard_prefix:
+        lines.append(f"    :standard_prefix: {standard_prefix}")
+    lines.extend([f"    :schema_root: {schema_root}", "", f"    {schema_name}", ""])
+    return "\n".join(lines)
+
+
+def _read_text(filename):
+    try:
+        with open(filename) as ff:
+            return ff.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def remove_stale_schema_docs(output_dir, keep):
+    """
+    Remove the generated schema documents in ``output_dir`` that are not in
+    ``keep``, along with any directories left empty. Only files that look
+    like documents generated by `create_schema_docs` are removed.
+    """
+    for dirpath, _, filenames in os.walk(output_dir, topdown=False):
+        for filename in filenames:
+            doc_path = os.path.normpath(os.path.join(dirpath, filename))
+            if not filename.endswith(".rst") or doc_path in keep:
+                continue
+            content = _read_text(doc_path)
+            if content is not None and content.startswith(".. _") and "\n.. asdf-schema::\n" in content:
+                os.remove(doc_path)
+        if dirpath != output_dir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
 
 
 def create_schema_docs(app, schemas):
+    """
+    Write the generated document for each schema. Documents are only written
+    when their contents change so that Sphinx doesn't consider unchanged
+    schema documents to be outdated.
+    """
+    generated_dir = posixpath.join(app.srcdir, "generated")
+    doc_paths = set()
     for schema in schemas:
         schema_name = schema.children[0].astext()
         standard_prefix = schema.standard_prefix or app.env.config.asdf_schema_standard_prefix
-        output_dir = posixpath.join(app.srcdir, "generated", standard_prefix)
+        output_dir = posixpath.join(generated_dir, standard_prefix)
         doc_path = posixpath.join(output_dir, schema_name + ".rst")
+        doc_paths.add(os.path.normpath(doc_path))
 
-        if posixpath.exists(doc_path):
+        content = render_schema_doc(schema_name, schema.schema_root, standard_prefix)
+        if _read_text(doc_path) == content:
             continue
 
         os.makedirs(posixpath.dirname(doc_path), exist_ok=True)
 
         with open(doc_path, "w") as ff:
-            ff.write(f".. _{standard_prefix}/{schema_name}:\n\n")
-            ff.write(schema_name + "\n")
-            ff.write("=" * len(schema_name) + "\n\n")
-            ff.write(".. asdf-schema::\n")
-            if standard_prefix:
-                ff.write(f"    :standard_prefix: {standard_prefix}\n")
-            ff.write(f"    :schema_root: {schema.schema_root}\n\n")
-            ff.write(f"    {schema_name}\n")
+            ff.write(content)
+
+    # Remove the documents of schemas no longer listed by any asdf-autoschemas
+    remove_stale_schema_docs(generated_dir, doc_paths)
 
 
 def autogenerate_schema_docs(app):
@@ -106,16 +292,30 @@ def autogenerate_schema_docs(app):
     ext = list(app.config.source_suffix)
     genfiles = [genfile + ((not genfile.endswith(tuple(ext)) and ext[0]) or "") for genfile in genfiles]
 
+    timer = build_timer(env)
     # Read all source documentation files and parse all asdf-schema directives
-    schemas = find_autoschema_references(app, genfiles)
+    with timer.phase("discovery"):
+        schemas = find_autoschema_references(app, genfiles)
     # Create the documentation files that correspond to the schemas listed
-    create_schema_docs(app, schemas)
+    with timer.phase("stub generation"):
+        create_schema_docs(app, schemas)
 
 
 def update_app_config(app, config):
-    from importlib.metadata import version
+    config.html_context["sphinx_asdf_version"] = sphinx_asdf_version()
+
 
-    config.html_context["sphinx_asdf_version"] = version("sphinx_asdf")
+def find_referencing_docs(app, env, added, changed, removed):
+    """
+    Schema documents are rebuilt whenever their schema file changes. Also
+    rebuild the documents that link to any of the changed documents.
+    """
+    outdated = set(changed) | set(removed)
+    return [
+        docname
+        for docname, references in doc_data(env, "asdf_schema_references").items()
+        if docname not in outdated and not references.isdisjoint(outdated)
+    ]
 
 
 def normalize_name(name):
@@ -125,19 +325,30 @@ def normalize_name(name):
 
 
 def add_labels_to_nodes(app, document):
+    """
+    Add a label for each schema property of a generated schema document, as
+    well as for the document itself. Other documents are left alone.
+    """
+    docname = app.env.docname
+    property_ids = app.env.temp_data.get("asdf_schema_ids")
+    if property_ids is None or not docname.startswith("generated/"):
+        return
+
     labels = app.env.domaindata["std"]["labels"]
     anonlabels = app.env.domaindata["std"]["anonlabels"]
     basepath = os.path.join("generated", app.env.config.asdf_schema_standard_prefix)
-
-    for node in traverse(document):
-        if isinstance(node, str) or not (isinstance(node, nodes.Node) and node["ids"]):
-            continue
-
-        labelid = node["ids"][0]
-        docname = app.env.docname
-        basename = os.path.relpath(docname, basepath)
-
-        if labelid == normalize_name(basename):
+    basename = os.path.relpath(docname, basepath)
+    docid = normalize_name(basename)
+
+    labelids = []
+    # The title of the document
+    section = next(iter(traverse(document, nodes.section)), None)
+    if section is not None and section["ids"] and section["ids"][0] == docid:
+        labelids.append(docid)
+    labelids.extend(property_ids)
+
+    for labelid in labelids:
+        if labelid == docid:
             name = basename
         else:
             name = nodes.fully_normalize_name(basename + ":" + labelid)
@@ -1,7 +1,12 @@
+import bisect
 import posixpath
+import re
+from contextlib import contextmanager
 from pprint import pformat
 
-import yaml
+import docutils
+import mistune
+import sphinx
 from docutils import nodes
 from docutils.parsers.rst import directives
 from docutils.statemachine import ViewList
@@ -9,6 +14,11 @@ from sphinx import addnodes
 from sphinx.util.docutils import SphinxDirective
 from sphinx.util.nodes import nested_parse_with_titles
 
+from .cache import DiskCache, cache_path, dumps_nodes, loads_nodes, prune_cache, sphinx_asdf_version
+from .envdata import doc_data
+from .examples import find_examples
+from .expansion import rendered_subtrees, schema_index
+from .fastpath import render_schema_html
 from .md2rst import md2rst
 from .nodes import (
     asdf_ref,
@@ -21,6 +31,7 @@ from .nodes import (
     schema_combiner_list,
     schema_description,
     schema_doc,
+    schema_expansion,
     schema_header_title,
     schema_properties,
     schema_property,
@@ -30,12 +41,32 @@ from .nodes import (
     section_header,
     toc_link,
 )
+from .profiling import NullTimer, profiled
+from .references import config_reference_mappings
+from .schema_store import load_schema
 
 SCHEMA_DEF_SECTION_TITLE = "Schema Definitions"
 EXAMPLE_SECTION_TITLE = "Examples"
 INTERNAL_DEFINITIONS_SECTION_TITLE = "Internal Definitions"
 ORIGINAL_SCHEMA_SECTION_TITLE = "Original Schema"
 
+# Version of the cached schema documentation (see cache.py)
+DOCTREE_CACHE_VERSION = 2
+
+UNCACHEABLE_NODES = (
+    nodes.system_message,
+    nodes.target,
+    nodes.footnote,
+    nodes.footnote_reference,
+    nodes.citation,
+    nodes.citation_reference,
+    nodes.substitution_reference,
+    nodes.pending,
+)
+
+# Matches the underline (or overline) of a section title, or a transition
+SECTION_ADORNMENT_PATTERN = re.compile(r"^([!-/:-@\[-`{-~])\1+[ \t]*$", re.MULTILINE)
+
 
 class schema_def(nodes.comment):
     def __init__(self, *args, **kwargs):
@@ -44,6 +75,13 @@ class schema_def(nodes.comment):
         super().__init__(*args, **kwargs)
 
 
+class markdown_fragment(nodes.Element):
+    """
+    Placeholder for a markdown fragment that has not been parsed yet. These
+    are replaced by the parsed fragment before the directive returns.
+    """
+
+
 class AsdfAutoschemas(SphinxDirective):
     required_arguments = 0
     optional_arguments = 2
@@ -96,20 +134,155 @@ class AsdfSchema(SphinxDirective):
     option_spec = {
         "schema_root": directives.path,
         "standard_prefix": directives.unchanged,
+        "expand_refs": directives.nonnegative_int,
     }
 
+    _timer = NullTimer()
+    _expand_depth = 0
+
     def run(self):
+        with profiled(self.env, "asdf-schema", self.content[0]) as self._timer:
+            return self._run()
+
+    def _run(self):
         self.envconfig = self.state.document.settings.env.config
         self.schema_name = self.content[0]
         schema_dir = self.options.get("schema_root", self.envconfig.asdf_schema_path)
         standard_prefix = self.options.get("standard_prefix", self.envconfig.asdf_schema_standard_prefix)
         srcdir = self.state.document.settings.env.srcdir
 
-        schema_file = posixpath.join(srcdir, schema_dir, standard_prefix, self.schema_name) + ".yaml"
+        schema_root = posixpath.join(srcdir, schema_dir, standard_prefix)
+        schema_file = posixpath.join(schema_root, self.schema_name) + ".yaml"
+
+        self._batch_markdown = self.envconfig.asdf_schema_batch_markdown
+        self._reference_mappings = config_reference_mappings(self.envconfig)
+        self._fragments = []
+        self._references = set()
+        self._hrefs = set()
+        self._ids = []
+        self._properties = []
+
+        # Rebuild this document whenever the schema changes
+        self.env.note_dependency(schema_file)
+        with self._timer.phase("yaml load"):
+            schema_entry = load_schema(schema_file)
+
+        self._expand_depth = self.options.get("expand_refs", 0)
+        self._expanding = [(schema_entry.path, schema_entry.tree.get("id", ""))]
+        expanded = []
+        if self._expand_depth:
+            self._schema_index = schema_index(schema_root)
+            expanded = sorted(self._schema_index.reach(schema_entry.path, self._expand_depth))
+            # The schemas shown inline are part of this document too
+            for path in expanded:
+                self.env.note_dependency(path)
+
+        cache_key = self._doctree_cache_key(schema_entry, schema_dir, standard_prefix, expanded)
+        docnodes = None
+        if cache_key is not None:
+            with self._timer.phase("doctree cache"):
+                docnodes = self._load_cached_doctree(cache_key)
+
+        if docnodes is None:
+            with self._timer.phase("tree walk"):
+                docnodes = self._create_schema_doc(schema_entry, schema_file)
+                if self.envconfig.asdf_schema_html_fast_path:
+                    docnodes = render_schema_html(docnodes)
+            for href in self._hrefs:
+                self._note_reference(href)
+            if cache_key is not None:
+                with self._timer.phase("doctree cache"):
+                    self._store_cached_doctree(cache_key, docnodes)
+
+        doc_data(self.env, "asdf_schema_references").setdefault(self.env.docname, set()).update(self._references)
+        # The ids of the schema properties are used to label them
+        self.env.temp_data.setdefault("asdf_schema_ids", []).extend(self._ids)
+        doc_data(self.env, "asdf_schema_properties").setdefault(self.env.docname, []).extend(
+            (self.schema_name, *prop) for prop in self._properties
+        )
+        if self.envconfig.asdf_schema_validate_examples:
+            # The examples are validated once all documents have been read
+            doc_data(self.env, "asdf_schema_examples").setdefault(self.env.docname, []).extend(
+                (schema_entry.path, str(schema_root), self.schema_name, index + 1, line, text)
+                for index, (line, text) in enumerate(find_examples(schema_entry))
+            )
 
-        with open(schema_file) as ff:
-            raw_content = ff.read()
-            schema = yaml.safe_load(raw_content)
+        return [docnodes]
+
+    def _doctree_cache_key(self, schema_entry, schema_dir, standard_prefix, expanded):
+        """
+        The key for the rendered documentation of a schema. It covers the
+        schema itself and everything else that affects how it is rendered.
+        """
+        if not self.envconfig.asdf_schema_doctree_cache:
+            return None
+
+        return repr(
+            (
+                DOCTREE_CACHE_VERSION,
+                sphinx_asdf_version(),
+                docutils.__version__,
+                sphinx.__version__,
+                mistune.__version__,
+                self.env.docname,
+                schema_entry.path,
+                schema_entry.digest,
+                schema_dir,
+                standard_prefix,
+                self.schema_name,
+                [tuple(mapping) for mapping in self.envconfig.asdf_schema_reference_mappings],
+                self.envconfig.asdf_schema_reference_mapping_match,
+                self.envconfig.asdf_schema_html_fast_path,
+                self._expand_depth,
+                [(path, load_schema(path).digest) for path in expanded],
+            )
+        )
+
+    def _doctree_cache(self):
+        return DiskCache(cache_path(self.env, "schema_docs"))
+
+    def _doctree_cache_slot(self):
+        # Each directive of a document has its own entry, which is replaced
+        # whenever the documentation it renders changes
+        return repr((self.env.docname, self.schema_name, sorted(self.options.items())))
+
+    def _load_cached_doctree(self, cache_key):
+        entry = self._doctree_cache().get(self._doctree_cache_slot())
+        if not isinstance(entry, dict) or entry.get("key") != cache_key:
+            return None
+        try:
+            docnodes = loads_nodes(entry["nodes"], self.state.document)
+        except Exception:
+            return None
+        self._references.update(entry["references"])
+        self._ids.extend(entry["ids"])
+        self._properties.extend(entry["properties"])
+        return docnodes
+
+    @staticmethod
+    def _is_cacheable(docnodes):
+        # Nodes that register themselves with the document while parsing, or
+        # problems that need to be reported again, can't be restored later.
+        for node in docnodes.findall(nodes.Element):
+            if isinstance(node, UNCACHEABLE_NODES) or "refname" in node:
+                return False
+        return True
+
+    def _store_cached_doctree(self, cache_key, docnodes):
+        if not self._is_cacheable(docnodes):
+            return
+        entry = {
+            "key": cache_key,
+            "nodes": dumps_nodes(docnodes),
+            "references": self._references,
+            "ids": self._ids,
+            "properties": self._properties,
+        }
+        self._doctree_cache().set(self._doctree_cache_slot(), entry)
+
+    def _create_schema_doc(self, schema_entry, schema_file):
+        raw_content = schema_entry.raw
+        schema = schema_entry.tree
 
         title = self._parse_title(schema.get("title", ""), schema_file)
 
@@ -149,7 +322,10 @@ class AsdfSchema(SphinxDirective):
         docnodes.append(section_header(text=ORIGINAL_SCHEMA_SECTION_TITLE))
         docnodes.append(nodes.literal_block(text=raw_content, language="yaml"))
 
-        return [docnodes]
+        with self._timer.phase("markdown"):
+            self._parse_markdown_fragments()
+
+        return docnodes
 
     def _create_toc(self, schema):
         toc = nodes.bullet_list()
@@ -165,17 +341,107 @@ class AsdfSchema(SphinxDirective):
         """
         This function is taken from the original schema conversion code written
         by Michael Droetboom.
+
+        When markdown is parsed in batches a placeholder is returned instead,
+        which is replaced by `_parse_markdown_fragments`.
+        """
+        with self._timer.phase("markdown"):
+            if getattr(self, "_batch_markdown", False):
+                placeholder = markdown_fragment()
+                self._fragments.append((placeholder, md2rst(text), filename))
+                return [placeholder]
+
+            return self._parse_rst([(md2rst(text), filename)])
+
+    def _parse_rst(self, fragments):
+        """
+        Parse reStructuredText fragments, given as ``(rst, filename)`` pairs,
+        in a single nested parse. The fragments are separated by empty
+        comments which end any preceding construct without consuming the
+        following lines. The nodes of each fragment are returned as a
+        separate list, or `None` if the result couldn't be split up.
         """
         rst = ViewList()
-        for i, line in enumerate(md2rst(text).split("\n")):
-            rst.append(line, filename, i + 1)
+        starts = []
+        for index, (text, filename) in enumerate(fragments):
+            if index:
+                rst.append("", filename, 0)
+                rst.append("..", filename, 0)
+                rst.append("", filename, 0)
+            starts.append(len(rst))
+            for i, line in enumerate(text.split("\n")):
+                rst.append(line, filename, i + 1)
 
         node = nodes.section()
         node.document = self.state.document
 
-        nested_parse_with_titles(self.state, rst, node)
+        with self._fragment_line_numbers(starts):
+            nested_parse_with_titles(self.state, rst, node)
+
+        if len(fragments) == 1:
+            return node.children
+
+        parsed = [[]]
+        for child in node.children:
+            if isinstance(child, nodes.comment) and not len(child):
+                parsed.append([])
+            else:
+                parsed[-1].append(child)
+
+        if len(parsed) != len(fragments):
+            return None
+
+        return parsed
+
+    @contextmanager
+    def _fragment_line_numbers(self, starts):
+        """
+        Report the line numbers of problems found while parsing a batch of
+        fragments relative to the fragment they are in, exactly like they
+        are when each fragment is parsed on its own.
+        """
+        reporter = self.state.memo.reporter
+        get_source_and_line = getattr(reporter, "get_source_and_line", None)
+        if get_source_and_line is None or len(starts) == 1:
+            yield
+            return
+
+        def fragment_source_and_line(lineno=None):
+            if lineno is not None:
+                lineno -= starts[bisect.bisect_right(starts, lineno - 1) - 1]
+            return get_source_and_line(lineno)
+
+        reporter.get_source_and_line = fragment_source_and_line
+        try:
+            yield
+        finally:
+            reporter.get_source_and_line = get_source_and_line
+
+    def _parse_markdown_fragments(self):
+        """
+        Parse all of the markdown fragments collected while building the
+        schema documentation and replace their placeholders. Fragments with
+        section titles or transitions can't be split back up after a batch
+        parse so they are parsed on their own.
+        """
+        fragments, self._fragments = self._fragments, []
+
+        batch = [fragment for fragment in fragments if not SECTION_ADORNMENT_PATTERN.search(fragment[1])]
+        single = [fragment for fragment in fragments if SECTION_ADORNMENT_PATTERN.search(fragment[1])]
+
+        parsed = self._parse_rst([(text, filename) for _, text, filename in batch]) if batch else []
+        if parsed is None:
+            # Something unexpected (e.g. an empty comment) was in a fragment
+            single = fragments
+            batch = parsed = []
 
-        return node.children
+        for fragment in single:
+            batch.append(fragment)
+            parsed.append(self._parse_rst([fragment[1:]]))
+
+        for (placeholder, _, _), children in zip(batch, parsed):
+            if placeholder.parent is not None:
+                placeholder.replace_self(children)
 
     def _parse_title(self, title, filename):
         nodes = self._markdown_to_nodes(title, filename)
@@ -186,18 +452,20 @@ class AsdfSchema(SphinxDirective):
         return schema_description(None, *nodes)
 
     def _resolve_reference(self, schema_id):
-        for mapping in self.envconfig.asdf_schema_reference_mappings:
-            if schema_id.startswith(mapping[0]):
-                relpath = posixpath.relpath(schema_id, mapping[0]).strip("/")
-                if relpath == ".":
-                    relpath = ""
-                schema_id = posixpath.join(mapping[1], relpath).strip("/")
-                break
-
-        if not schema_id.endswith(".html"):
-            schema_id += ".html"
+        return self._reference_mappings.resolve(schema_id)
 
-        return schema_id
+    def _note_reference(self, href):
+        """
+        Record the document a reference links to, if it is part of this
+        project, so that this document can be rebuilt when it changes.
+        """
+        if "://" in href or "*" in href:
+            return
+        if href.endswith(".html"):
+            href = href[: -len(".html")]
+        docname = posixpath.normpath(posixpath.join(posixpath.dirname(self.env.docname), href))
+        if docname != self.env.docname:
+            self._references.add(docname)
 
     def _create_reference(self, refname, shorten=False):
         if "#" in refname:
@@ -208,6 +476,7 @@ class AsdfSchema(SphinxDirective):
 
         if schema_id:
             schema_id = self._resolve_reference(schema_id)
+            self._hrefs.add(schema_id)
         if fragment:
             components = fragment.split("/")
             fragment = f"#{'-'.join(components[1:])}"
@@ -230,6 +499,68 @@ class AsdfSchema(SphinxDirective):
         treenodes.append(asdf_ref(text=refname, href=href))
         return treenodes
 
+    def _expand_reference(self, ref, path):
+        """
+        The referenced schema rendered inline, if it is within the depth
+        given by ``:expand_refs:`` and isn't already being expanded.
+
+        Every referenced schema is only rendered once per build for each
+        depth, with the ids of its properties relative to the reference, and
+        then copied to each place it is expanded. Whether a schema further
+        down is expanded depends on the schemas being expanded around it,
+        so those that it can reach are part of the key of the copy.
+        """
+        depth = self._expand_depth - len(self._expanding) + 1
+        if depth <= 0:
+            return []
+        target = self._schema_index.find(ref, self._expanding[-1][1])
+        if target is None or any(target == expanding for expanding, _ in self._expanding):
+            return []
+
+        reach = self._schema_index.reach(target, depth - 1)
+        # Schemas that don't reference any others look the same at any depth
+        key = (
+            target,
+            depth - 1 if reach else 0,
+            frozenset(expanding for expanding, _ in self._expanding if expanding in reach),
+        )
+        if key in rendered_subtrees:
+            data, ids, hrefs = rendered_subtrees[key]
+            expansion = loads_nodes(data, self.state.document)
+        else:
+            expansion, ids, hrefs = self._render_expansion(target)
+            if self._is_cacheable(expansion):
+                rendered_subtrees[key] = (dumps_nodes(expansion), ids, hrefs)
+
+        # Move the ids of the properties below the reference
+        relocated = {old: self._append_to_path(path, old) if old else path for old in ids}
+        for node in expansion.findall(nodes.Element):
+            for attr in ("id", "path"):
+                if attr in node:
+                    node[attr] = self._append_to_path(path, node[attr]) if node[attr] else path
+            node["ids"] = [relocated.get(old, old) for old in node["ids"]]
+        self._ids.extend(relocated.values())
+        self._hrefs.update(hrefs)
+        return [expansion]
+
+    def _render_expansion(self, path):
+        tree = load_schema(path).tree
+        # The properties of the referenced schema are indexed with that schema
+        saved = self._ids, self._hrefs, self._fragments, self._properties
+        self._ids, self._hrefs, self._fragments, self._properties = [], set(), [], []
+        self._expanding.append((path, tree.get("id", "")))
+        try:
+            expansion = schema_expansion()
+            if tree.get("title"):
+                expansion.append(self._parse_title(tree["title"], path))
+            expansion.append(self._process_properties(tree, top=True))
+            with self._timer.phase("markdown"):
+                self._parse_markdown_fragments()
+            return expansion, self._ids, self._hrefs
+        finally:
+            self._expanding.pop()
+            self._ids, self._hrefs, self._fragments, self._properties = saved
+
     def _create_enum_node(self, enum_values):
         enum_nodes = nodes.compound()
         enum_nodes.append(nodes.paragraph(text="Only the following values are valid for this node:"))
@@ -351,10 +682,10 @@ class AsdfSchema(SphinxDirective):
             return schema_properties(None, details, id=path)
         elif "$ref" in schema:
             ref = self._create_ref_node(schema["$ref"])
-            return schema_properties(None, *[ref], id=path)
+            return schema_properties(None, ref, *self._expand_reference(schema["$ref"], path), id=path)
         elif "tag" in schema:
             ref = self._create_ref_node(schema["tag"])
-            return schema_properties(None, *[ref], id=path)
+            return schema_properties(None, ref, *self._expand_reference(schema["tag"], path), id=path)
         else:
             text = nodes.emphasis(text="This node has no type definition (unrestricted)")
             return schema_properties(None, text, id=path)
@@ -384,19 +715,23 @@ class AsdfSchema(SphinxDirective):
 
         container_node.append(combiner_list)
         container_node["ids"] = [path]
+        self._ids.append(path)
         return schema_properties(None, *[container_node], id=path)
 
     def _create_property_node(self, name, tree, required, path=""):
         title = tree.get("title", "")
         description = tree.get("description", "")
 
+        expansion = []
         if "$ref" in tree:
             typ, ref = self._create_reference(tree.get("$ref"), shorten=True)
+            expansion = self._expand_reference(tree["$ref"], path)
         elif "tag" in tree:
             _tag = tree.get("tag")
             typ, ref = self._create_reference(_tag, shorten=True)
             if "*" in _tag:
                 ref = None
+            expansion = self._expand_reference(_tag, path)
         else:
             typ = tree.get("type", "object")
             ref = None
@@ -410,8 +745,11 @@ class AsdfSchema(SphinxDirective):
             prop.extend(self._process_validation_keywords(tree, typename=typ, path=path))
         else:
             prop.append(self._process_properties(tree, path=path))
+        prop.extend(expansion)
 
         prop["ids"] = [path]
+        self._ids.append(path)
+        self._properties.append((path, typ, title.strip().split("\n")[0]))
         return prop
 
     def _process_examples(self, tree, filename):
@@ -424,3 +762,8 @@ class AsdfSchema(SphinxDirective):
             node.append(nodes.literal_block(text=example[-1], language="yaml"))
             examples.append(node)
         return examples
+
+
+def prune_doctree_cache(app, exception):
+    if exception is None and app.config.asdf_schema_doctree_cache:
+        prune_cache(app.env, "schema_docs")
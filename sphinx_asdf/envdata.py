@@ -0,0 +1,46 @@
+"""
+Per-document data that sphinx-asdf collects in the build environment while
+documents are read. Each kind of data is stored as an attribute of the
+environment holding a dict keyed by docname, so that the data of a document
+can be purged when it is read again and merged back from parallel reads.
+"""
+
+# Environment attributes holding per-document data
+DOC_DATA = [
+    # docname -> set of the docnames of the schema documents it links to
+    "asdf_schema_references",
+    # docname -> list of (schema name, property id, type, title) of the
+    # properties of the schemas documented by the document
+    "asdf_schema_properties",
+    # docname -> list of the profiled directives of the document
+    "asdf_profile",
+    # docname -> list of (schema file, schema root, schema name, number, line,
+    # text) of the examples of the schemas documented by the document, until
+    # they have been validated
+    "asdf_schema_examples",
+    # docname -> size of the pickled doctree of a schema document, in bytes
+    "asdf_doctree_sizes",
+]
+
+
+def doc_data(env, name):
+    """Get the per-document data stored on the environment under ``name``"""
+    data = getattr(env, name, None)
+    if data is None:
+        data = {}
+        setattr(env, name, data)
+    return data
+
+
+def purge_doc_data(app, env, docname):
+    for name in DOC_DATA:
+        doc_data(env, name).pop(docname, None)
+
+
+def merge_doc_data(app, env, docnames, other):
+    for name in DOC_DATA:
+        data = doc_data(env, name)
+        other_data = doc_data(other, name)
+        for docname in docnames:
+            if docname in other_data:
+                data[docname] = other_data[docname]
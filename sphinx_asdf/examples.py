@@ -0,0 +1,174 @@
+"""
+Validation of the examples of the documented schemas, enabled by the
+``asdf_schema_validate_examples`` configuration value.
+
+The examples of each schema are collected while documents are read and
+validated against their schema with asdf once all documents have been read.
+The ``$ref`` of the schemas to other schemas below the schema root are
+resolved to those schemas. The results are cached by the example and the
+contents of the schemas it is validated against, so an example is only
+validated again when any of them changes. Invalid examples are reported as
+warnings at their location in the schema file, examples that could not be
+validated (for example because a reference could not be resolved) only as
+an info message.
+"""
+
+import io
+from urllib.parse import urljoin
+
+import asdf
+import asdf.schema
+import asdf.yamlutil
+from asdf.exceptions import ValidationError
+from sphinx.util import logging
+from sphinx.util.parallel import ParallelTasks, make_chunks
+
+from .cache import DiskCache, cache_path, prune_cache
+from .envdata import doc_data
+from .expansion import find_references, schema_index
+from .parallel import worker_count
+from .schema_store import load_schema
+
+logger = logging.getLogger(__name__)
+
+# Version of the cached validation results (see cache.py)
+EXAMPLE_CACHE_VERSION = 2
+
+# Examples use the tag shorthand of the ASDF standard, as in ASDF files
+EXAMPLE_HEADER = "%YAML 1.1\n%TAG ! tag:stsci.edu:asdf/\n---\n"
+
+
+def find_examples(schema_entry):
+    """
+    The ``(line, text)`` of each example of a schema. The line is the first
+    line of the text of the example in the schema file.
+    """
+    raw = schema_entry.raw
+    start = raw.find("examples:")
+    examples = []
+    for example in schema_entry.tree.get("examples", []):
+        text = example[-1]
+        first_line = next((line.strip() for line in text.splitlines() if line.strip()), "")
+        pos = raw.find(first_line, max(start, 0)) if first_line else -1
+        if pos == -1:
+            pos = max(start, 0)
+        else:
+            start = pos + len(first_line)
+        examples.append((raw.count("\n", 0, pos) + 1, text))
+    return examples
+
+
+# The problems found by `validate_example`
+INVALID = "invalid"
+UNVALIDATED = "unvalidated"
+
+
+def referenced_schemas(schema_path, schema_root):
+    """
+    The schemas below the schema root that a schema references with
+    ``$ref``, directly or through other schemas, as a dict of the URI of
+    each reference to the path of the schema.
+    """
+    index = schema_index(schema_root)
+    found = {}
+    pending = [schema_path]
+    seen = {schema_path}
+    while pending:
+        tree = load_schema(pending.pop()).tree
+        base_id = tree.get("id", "") if isinstance(tree, dict) else ""
+        for ref in find_references(tree, keys=("$ref",)):
+            ref = ref.partition("#")[0]
+            path = index.find(ref, base_id) if ref else None
+            if path is None:
+                continue
+            found[urljoin(base_id, ref)] = path
+            if path not in seen:
+                seen.add(path)
+                pending.append(path)
+    return found
+
+
+def validate_example(schema_path, schema_root, text):
+    """
+    `None` if the example is valid, otherwise the kind of problem
+    (`INVALID` or `UNVALIDATED`) and a description of it.
+    """
+    schema = load_schema(schema_path).tree
+    resources = {
+        uri: load_schema(path).raw.encode("utf-8") for uri, path in referenced_schemas(schema_path, schema_root).items()
+    }
+    try:
+        tree = asdf.yamlutil.load_tree(io.StringIO(EXAMPLE_HEADER + text))
+        with asdf.config_context() as config:
+            config.add_resource_mapping(resources)
+            asdf.schema.validate(tree, schema=schema)
+    except ValidationError as err:
+        path = "/".join(str(item) for item in err.absolute_path)
+        return INVALID, f"{err.message} (at {path})" if path else err.message
+    except Exception as err:
+        return UNVALIDATED, str(err)
+    return None
+
+
+def _validate_examples(items):
+    return [(key, validate_example(*args)) for key, *args in items]
+
+
+def _cache_key(schema_path, schema_root, text):
+    # The result also depends on the schemas the schema references
+    references = sorted(
+        (uri, load_schema(path).digest) for uri, path in referenced_schemas(schema_path, schema_root).items()
+    )
+    return repr((EXAMPLE_CACHE_VERSION, asdf.__version__, load_schema(schema_path).digest, references, text))
+
+
+def validate_schema_examples(app, env):
+    """Validate the examples of the schemas documented by the documents read"""
+    # Only the documents read since the last validation are in here
+    examples = doc_data(env, "asdf_schema_examples")
+    items = sorted({item for doc_examples in examples.values() for item in doc_examples})
+    examples.clear()
+    if not app.config.asdf_schema_validate_examples or not items:
+        return
+
+    cache = DiskCache(cache_path(env, "examples"))
+    keys = [_cache_key(schema_path, schema_root, text) for schema_path, schema_root, _, _, _, text in items]
+    results = {}
+    pending = {}
+    for key, (schema_path, schema_root, _, _, _, text) in zip(keys, items):
+        entry = cache.get(key)
+        if isinstance(entry, dict):
+            results[key] = entry["problem"]
+        else:
+            pending[key] = (key, schema_path, schema_root, text)
+
+    validated = []
+    nproc = worker_count(app, app.config.asdf_schema_validation_workers)
+    if nproc > 1 and len(pending) > 1:
+        # Each worker validates a chunk of the examples in a forked process
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(list(pending.values()), nproc):
+            tasks.add_task(_validate_examples, chunk, lambda chunk, result: validated.extend(result))
+        tasks.join()
+    else:
+        validated = _validate_examples(pending.values())
+
+    for key, problem in validated:
+        results[key] = problem
+        cache.set(key, {"problem": problem})
+
+    for key, (schema_path, _, name, index, line, _) in zip(keys, items):
+        problem = results[key]
+        if problem is None:
+            continue
+        kind, message = problem
+        location = f"{schema_path}:{line}"
+        if kind == INVALID:
+            logger.warning("invalid example %d of schema %s: %s", index, name, message, location=location)
+        else:
+            logger.info("example %d of schema %s could not be validated: %s", index, name, message, location=location)
+
+
+def prune_example_cache(app, exception):
+    if exception is None and app.config.asdf_schema_validate_examples:
+        prune_cache(app.env, "examples")
@@ -0,0 +1,114 @@
+"""
+Lookup of the schemas referenced with ``$ref`` or ``tag``, for the
+``:expand_refs:`` option of the ``asdf-schema`` directive, along with the
+referenced schemas that have already been rendered during this build.
+"""
+
+import os
+from urllib.parse import urljoin
+
+import yaml
+
+from .schema_store import load_schema
+
+# Referenced schemas rendered during this build, see
+# `AsdfSchema._expand_reference` for the keys
+rendered_subtrees = {}
+
+_indexes = {}
+
+
+class SchemaIndex:
+    """
+    The schemas below a schema root by their id, their tag and their name
+    relative to the root (without the ``.yaml`` extension).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._paths = {}
+        self._targets = {}
+        self._reach = {}
+
+        names = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith(".yaml"):
+                    continue
+                path = os.path.abspath(os.path.join(dirpath, filename))
+                try:
+                    tree = load_schema(path).tree
+                except (OSError, UnicodeDecodeError, yaml.YAMLError):
+                    continue
+                if not isinstance(tree, dict):
+                    continue
+                for key in ("id", "tag"):
+                    if isinstance(tree.get(key), str):
+                        self._paths.setdefault(tree[key], path)
+                name = os.path.relpath(path, root)[: -len(".yaml")]
+                names[name.replace(os.sep, "/")] = path
+
+        # Ids and tags take precedence over names
+        for name, path in names.items():
+            self._paths.setdefault(name, path)
+
+    def find(self, ref, base_id=""):
+        """
+        The path of the schema a reference points to, or `None`. References
+        to a part of a schema (or to several schemas) are not resolved.
+        """
+        ref, _, fragment = ref.partition("#")
+        if not ref or fragment or "*" in ref:
+            return None
+        path = self._paths.get(ref)
+        if path is None and base_id:
+            path = self._paths.get(urljoin(base_id, ref))
+        return path
+
+    def targets(self, path):
+        """The paths of the other schemas referenced by a schema"""
+        if path not in self._targets:
+            tree = load_schema(path).tree
+            base_id = tree.get("id", "")
+            found = {self.find(ref, base_id) for ref in find_references(tree)}
+            self._targets[path] = frozenset(found - {None, path})
+        return self._targets[path]
+
+    def reach(self, path, depth):
+        """The paths of the schemas that can be reached in ``depth`` references"""
+        key = (path, depth)
+        if key not in self._reach:
+            found = set()
+            if depth > 0:
+                for target in self.targets(path):
+                    found.add(target)
+                    found.update(self.reach(target, depth - 1))
+            self._reach[key] = frozenset(found)
+        return self._reach[key]
+
+
+def find_references(tree, keys=("$ref", "tag")):
+    """The values of the ``$ref`` and ``tag`` (or other ``keys``) of a schema"""
+    if isinstance(tree, dict):
+        for key, value in tree.items():
+            if key in keys and isinstance(value, str):
+                yield value
+            else:
+                yield from find_references(value, keys)
+    elif isinstance(tree, list):
+        for item in tree:
+            yield from find_references(item, keys)
+
+
+def schema_index(root):
+    root = os.path.abspath(root)
+    if root not in _indexes:
+        _indexes[root] = SchemaIndex(root)
+    return _indexes[root]
+
+
+def clear_expansions(app):
+    # The schemas may have changed since the previous build
+    _indexes.clear()
+    rendered_subtrees.clear()
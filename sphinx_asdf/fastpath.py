@@ -0,0 +1,74 @@
+"""
+Rendering of the schema documentation to HTML while documents are read.
+
+With ``asdf_schema_html_fast_path`` the sphinx-asdf nodes of a schema
+document are replaced by the HTML their visitors produce, so that they don't
+need to be pickled, unpickled and visited one by one. Other nodes (such as
+the parsed markdown and the literal blocks, which are highlighted by the
+builder) are kept and rendered by the builder as usual.
+"""
+
+from docutils import nodes
+from docutils.writers._html_base import HTMLTranslator
+
+from .nodes import custom_nodes
+
+_custom_nodes = tuple(custom_nodes)
+
+
+class schema_html(nodes.Element):
+    """
+    Pre-rendered HTML, given by the ``chunks`` attribute, with the children
+    rendered in between the chunks.
+    """
+
+    def visit_html(self, node):
+        chunks = node["chunks"]
+        for chunk, child in zip(chunks, node.children):
+            self.body.append(chunk)
+            child.walkabout(self)
+        self.body.append(chunks[-1])
+        raise nodes.SkipNode
+
+    def depart_html(self, node):
+        pass
+
+
+class _MarkupCollector:
+    """Stands in for the HTML translator of the visitors of the nodes"""
+
+    def __init__(self):
+        self.body = []
+
+
+def render_schema_html(docnodes):
+    """Replace the sphinx-asdf nodes of a subtree by their HTML"""
+    collector = _MarkupCollector()
+    children = []
+
+    def render(node):
+        if isinstance(node, nodes.Text):
+            # Like the translator does for any text outside of literals
+            collector.body.append(str(node).translate(HTMLTranslator.special_characters))
+        elif isinstance(node, _custom_nodes):
+            type(node).visit_html(collector, node)
+            for child in node.children:
+                render(child)
+            type(node).depart_html(collector, node)
+        else:
+            children.append(node)
+            collector.body.append(None)
+
+    render(docnodes)
+
+    # The markup before, in between and after the children
+    chunks = []
+    parts = []
+    for part in collector.body:
+        if part is None:
+            chunks.append("".join(parts))
+            parts = []
+        else:
+            parts.append(part)
+    chunks.append("".join(parts))
+    return schema_html("", *children, chunks=chunks)
@@ -0,0 +1,97 @@
+"""
+A cache of the highlighted YAML of the literal blocks written by the builder.
+
+The original schema and the examples of every schema document are YAML
+blocks that Pygments would highlight again on every build. With
+``asdf_highlight_cache`` the highlighted markup is cached next to the
+doctrees, keyed by the text of the block, its language and options, and the
+highlighter (output format and Pygments style) used. Each builder has its own
+cache, so that a build with one builder doesn't prune the entries of another.
+"""
+
+import logging
+from contextlib import contextmanager
+
+import pygments
+import sphinx
+
+from .cache import DiskCache, cache_path, content_hash, prune_cache
+
+# Version of the cached markup (see cache.py)
+HIGHLIGHT_CACHE_VERSION = 1
+
+# Only blocks in these languages are cached
+HIGHLIGHT_CACHE_LANGUAGES = ("yaml",)
+
+# The logger Sphinx reports problems with highlighting to
+HIGHLIGHT_LOGGER = "sphinx.sphinx.highlighting"
+
+
+class _WarningRecorder(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@contextmanager
+def _recorded_warnings():
+    recorder = _WarningRecorder()
+    logger = logging.getLogger(HIGHLIGHT_LOGGER)
+    logger.addHandler(recorder)
+    try:
+        yield recorder.records
+    finally:
+        logger.removeHandler(recorder)
+
+
+class CachedHighlighter:
+    """
+    Wraps the highlighter of a builder. Blocks that could only be highlighted
+    with a warning are not cached, so that the warning is reported again.
+    """
+
+    def __init__(self, highlighter, cache):
+        self._highlighter = highlighter
+        self._cache = cache
+        formatter_args = {name: getattr(arg, "__qualname__", arg) for name, arg in highlighter.formatter_args.items()}
+        self._key = (
+            HIGHLIGHT_CACHE_VERSION,
+            pygments.__version__,
+            sphinx.__version__,
+            highlighter.dest,
+            sorted(formatter_args.items()),
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._highlighter, name)
+
+    def highlight_block(self, source, lang, opts=None, force=False, location=None, **kwargs):
+        if lang not in HIGHLIGHT_CACHE_LANGUAGES:
+            return self._highlighter.highlight_block(source, lang, opts, force, location, **kwargs)
+
+        key = repr((*self._key, lang, opts, force, sorted(kwargs.items()), content_hash(source.encode())))
+        highlighted = self._cache.get(key)
+        if highlighted is not None:
+            return highlighted
+
+        with _recorded_warnings() as warnings:
+            highlighted = self._highlighter.highlight_block(source, lang, opts, force, location, **kwargs)
+        if not warnings:
+            self._cache.set(key, highlighted)
+        return highlighted
+
+
+def cache_highlighting(app):
+    highlighter = getattr(app.builder, "highlighter", None)
+    if app.config.asdf_highlight_cache and highlighter is not None and not isinstance(highlighter, CachedHighlighter):
+        cache = DiskCache(cache_path(app.env, "highlight", app.builder.name))
+        app.builder.highlighter = CachedHighlighter(highlighter, cache)
+
+
+def prune_highlighting(app, exception):
+    # Only the builder that used the cache wrote every document
+    if exception is None and isinstance(getattr(app.builder, "highlighter", None), CachedHighlighter):
+        prune_cache(app.env, "highlight", app.builder.name)
@@ -0,0 +1,190 @@
+"""
+Lazy loading of the deeply nested properties and the original YAML of the
+schema documentation in HTML output.
+
+When ``asdf_schema_lazy_depth`` or ``asdf_schema_lazy_original`` is set, the
+HTML of these sections is written to a JSON file next to the pages instead of
+into the page itself, and a small script fetches it when the reader opens
+the section. The files are named by the hash of their contents so that
+sections shared by several pages are only written (and downloaded) once.
+A build that writes every page removes the files it didn't use.
+"""
+
+import html
+import json
+import os
+
+from docutils import nodes
+from sphinx.util import logging
+from sphinx.util.osutil import relative_uri
+
+from .cache import atomic_write, cache_path, content_hash
+from .directives import ORIGINAL_SCHEMA_SECTION_TITLE
+from .nodes import schema_doc, schema_expansion, schema_properties, schema_property, section_header
+
+logger = logging.getLogger(__name__)
+
+# Directory of the section files, relative to the output directory
+LAZY_DIRNAME = "_asdf"
+
+# Only these builders write one page per document next to the section files
+LAZY_BUILDERS = ("html", "dirhtml")
+
+# Marks the start of a build, the section files used since then are kept
+LAZY_STAMP = "lazy.stamp"
+
+LAZY_SCRIPT = """
+document.addEventListener("DOMContentLoaded", () => {
+  const sections = [...document.querySelectorAll("details.asdf-lazy")];
+  const load = (section) => {
+    if (section.dataset.loaded) {
+      return Promise.resolve();
+    }
+    section.dataset.loaded = "true";
+    return fetch(section.dataset.src)
+      .then((response) => response.json())
+      .then((data) => {
+        section.querySelector(".asdf-lazy-content").innerHTML = data.html;
+      });
+  };
+  sections.forEach((section) => {
+    section.addEventListener("toggle", () => section.open && load(section));
+  });
+  // Open every section when the page is linked to a property inside of one
+  const target = decodeURIComponent(window.location.hash.slice(1));
+  if (target && !document.getElementById(target)) {
+    Promise.all(sections.map((section) => {
+      section.open = true;
+      return load(section);
+    })).then(() => document.getElementById(target)?.scrollIntoView());
+  }
+});
+"""
+
+
+class lazy_section(nodes.Element):
+    """
+    A section whose HTML is written to a separate file. The children are
+    rendered as usual and then moved from the page body to the file.
+    """
+
+    def visit_html(self, node):
+        node["body_start"] = len(self.body)
+
+    def depart_html(self, node):
+        start = node["body_start"]
+        data = json.dumps({"html": "".join(self.body[start:])}).encode("utf-8")
+        del self.body[start:]
+
+        filename = f"{content_hash(data)}.json"
+        path = os.path.join(self.builder.outdir, LAZY_DIRNAME, filename)
+        if os.path.exists(path):
+            # Mark the file as used, see `prune_lazy_sections`
+            os.utime(path)
+        else:
+            with atomic_write(path) as ff:
+                ff.write(data)
+
+        uri = relative_uri(self.builder.get_target_uri(self.builder.current_docname), f"{LAZY_DIRNAME}/{filename}")
+        self.body.append(
+            f'<details class="asdf-lazy" data-src="{html.escape(uri)}">'
+            f"<summary>{html.escape(node['label'])}</summary>"
+            '<div class="asdf-lazy-content"></div></details>'
+        )
+
+
+def _lazy_enabled(app):
+    config = app.config
+    return app.builder.name in LAZY_BUILDERS and (config.asdf_schema_lazy_depth or config.asdf_schema_lazy_original)
+
+
+def add_lazy_script(app):
+    if _lazy_enabled(app):
+        if app.config.asdf_schema_html_fast_path:
+            logger.warning("the schema documentation rendered by asdf_schema_html_fast_path can't be loaded lazily")
+        app.add_js_file(None, body=LAZY_SCRIPT)
+
+
+def _wrap(node, label):
+    section = lazy_section(label=label)
+    node.replace_self(section)
+    section.append(node)
+
+
+def _property_depth(node):
+    depth = 0
+    parent = node.parent
+    while parent is not None:
+        if isinstance(parent, schema_property):
+            depth += 1
+        parent = parent.parent
+    return depth
+
+
+def stamp_lazy_sections(app, env):
+    """
+    Record the start of the writing of the pages, and the pages written from
+    then on, for `prune_lazy_sections`.
+    """
+    if app.builder.name in LAZY_BUILDERS:
+        stamp = cache_path(env, LAZY_STAMP)
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp, "wb"):
+            pass
+        app.builder.asdf_lazy_stamp = os.stat(stamp).st_mtime_ns
+        app.builder.asdf_lazy_docnames = set()
+
+
+def defer_schema_sections(app, doctree, docname):
+    """
+    Move the properties nested deeper than ``asdf_schema_lazy_depth`` levels,
+    and the original schema if ``asdf_schema_lazy_original`` is set, to
+    sections that are loaded when they are opened.
+    """
+    # Documents are also resolved while looking for schemas, before the
+    # pages are written
+    written = getattr(app.builder, "asdf_lazy_docnames", None)
+    if written is not None:
+        written.add(docname)
+    if not _lazy_enabled(app):
+        return
+
+    max_depth = app.config.asdf_schema_lazy_depth
+    for doc in doctree.findall(schema_doc):
+        if max_depth:
+            # Only the outermost of the nested properties are wrapped
+            for prop in list(doc.findall(schema_property)):
+                if _property_depth(prop) + 1 != max_depth:
+                    continue
+                for child in list(prop.children):
+                    if isinstance(child, (schema_properties, schema_expansion)) and any(child.findall(schema_property)):
+                        _wrap(child, "Show nested properties")
+
+        if app.config.asdf_schema_lazy_original:
+            for header in list(doc.findall(section_header)):
+                sibling = header.next_node(descend=False, siblings=True)
+                if header.astext() == ORIGINAL_SCHEMA_SECTION_TITLE and isinstance(sibling, nodes.literal_block):
+                    _wrap(sibling, "Show the original schema")
+
+
+def prune_lazy_sections(app, exception):
+    """
+    Remove the section files that were not used by a build that wrote every
+    page, such as the ones of removed schemas or of a lower
+    ``asdf_schema_lazy_depth``. Other builds only write some of the pages, the
+    rest may still load any of the files.
+    """
+    written = getattr(app.builder, "asdf_lazy_docnames", None)
+    if exception is not None or written is None or not app.env.found_docs <= written:
+        return
+
+    directory = os.path.join(app.builder.outdir, LAZY_DIRNAME)
+    if not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            if os.stat(path).st_mtime_ns < app.builder.asdf_lazy_stamp:
+                os.remove(path)
+        except OSError:
+            pass
@@ -4,7 +4,9 @@ to maintain consistency with the old custom markdown to
 rst converter that used to be in this file.
 """
 
+import functools
 import textwrap
+import threading
 
 import mistune
 from mistune.renderers.rst import RSTRenderer
@@ -33,7 +35,14 @@ def parse_block_math(block, m, state):
     return m.end() + 1
 
 
-def md2rst(content):
+# Maximum number of conversions kept by the md2rst cache. Schemas tend to
+# repeat the same titles and descriptions so even a modest cache helps.
+MD2RST_CACHE_SIZE = 4096
+
+_converters = threading.local()
+
+
+def create_converter():
     renderer = RSTRenderer()
     renderer.register("inline_math", inline_math_to_rst)
     renderer.register("block_math", block_math_to_rst)
@@ -42,4 +51,24 @@ def md2rst(content):
     converter.inline.register("inline_math", INLINE_MATH_PATTERN, parse_inline_math, before="link")
     BLOCK_MATH_PATTERN = r"\$\$(?P<math_text>[\w\W]*?)\$\$"
     converter.block.register("block_math", BLOCK_MATH_PATTERN, parse_block_math, before="list")
-    return converter(content)
+    return converter
+
+
+def get_converter():
+    """
+    The markdown converter is only configured once, but as it is not
+    guaranteed to be thread-safe each thread gets its own converter.
+    """
+    converter = getattr(_converters, "converter", None)
+    if converter is None:
+        converter = _converters.converter = create_converter()
+    return converter
+
+
+@functools.lru_cache(maxsize=MD2RST_CACHE_SIZE)
+def md2rst(content):
+    """
+    Convert markdown to reStructuredText. Conversions are memoized, use
+    ``md2rst.cache_info()`` to get the cache hit and miss counts.
+    """
+    return get_converter()(content)
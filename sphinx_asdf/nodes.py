@@ -72,6 +72,14 @@ class schema_property(nodes.compound):
         self.body.append(r"</li>")
 
 
+class schema_expansion(nodes.compound):
+    def visit_html(self, node):
+        self.body.append(r'<div class="schema-expansion">')
+
+    def depart_html(self, node):
+        self.body.append(r"</div>")
+
+
 class schema_property_name(nodes.line):
     def visit_html(self, node):
         self.body.append(r'<div class="schema-property-name"><h4>')
@@ -172,6 +180,7 @@ custom_nodes = [
     schema_description,
     schema_properties,
     schema_property,
+    schema_expansion,
     schema_property_name,
     schema_property_details,
     schema_combiner_body,
@@ -0,0 +1,19 @@
+"""
+Helpers for the work that sphinx-asdf spreads over the processes of Sphinx's
+`~sphinx.util.parallel.ParallelTasks`.
+"""
+
+from sphinx.util.parallel import parallel_available
+
+
+def worker_count(app, workers):
+    """
+    The number of processes to use for a ``*_workers`` configuration value,
+    which is a number or ``"auto"`` for the number of processes given to
+    ``sphinx-build -j``. Always 1 where Sphinx can't fork workers.
+    """
+    if workers == "auto":
+        workers = app.parallel
+    if not parallel_available or not workers:
+        return 1
+    return max(int(workers), 1)
@@ -0,0 +1,163 @@
+"""
+Opt-in profiling of the time sphinx-asdf spends building the documentation,
+enabled by the ``asdf_profile`` configuration value.
+
+The time spent in each directive is stored per document in the environment
+(so that it is merged back from parallel reads) and a report is written once
+the build is finished.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from sphinx.util import logging
+
+from .cache import dumps_nodes
+from .envdata import doc_data
+
+logger = logging.getLogger(__name__)
+
+# Default name of the report, relative to the output directory
+PROFILE_REPORT = "asdf_profile.json"
+
+# Number of items listed by the console summary
+PROFILE_SUMMARY_SIZE = 10
+
+
+class Timer:
+    """
+    Accumulates the time spent in named phases. Phases may be nested, the
+    time of a phase excludes the time spent in the phases nested in it.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._nested = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+
+class NullTimer:
+    """A `Timer` that doesn't time anything, used when profiling is disabled"""
+
+    phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+
+def profiling_enabled(env):
+    return bool(env.config.asdf_profile)
+
+
+@contextmanager
+def profiled(env, kind, name):
+    """
+    Profile a directive of the document being read. The timer is yielded so
+    that the directive can break its time down into phases.
+    """
+    if not profiling_enabled(env):
+        yield NullTimer()
+        return
+
+    timer = Timer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        item = {"kind": kind, "name": name, "total": time.perf_counter() - start, "phases": timer.phases}
+        doc_data(env, "asdf_profile").setdefault(env.docname, []).append(item)
+
+
+def build_timer(env):
+    """Timer of the work done for the whole build, before any document is read"""
+    if not profiling_enabled(env):
+        return NullTimer()
+    timer = Timer()
+    env.asdf_build_profile = timer.phases
+    return timer
+
+
+def record_doctree_size(app, doctree):
+    """Record the size of the doctree of each document with schema documentation"""
+    if profiling_enabled(app.env) and "asdf_schema_ids" in app.env.temp_data:
+        # The document itself holds the settings and state of the reader
+        size = len(dumps_nodes(doctree.children))
+        doc_data(app.env, "asdf_doctree_sizes")[app.env.docname] = size
+
+
+def reset_profile(app):
+    # Only the documents read by this build are profiled
+    doc_data(app.env, "asdf_profile").clear()
+    doc_data(app.env, "asdf_doctree_sizes").clear()
+    app.env.asdf_build_profile = {}
+
+
+def report_path(app):
+    filename = app.config.asdf_profile
+    if not isinstance(filename, str):
+        filename = PROFILE_REPORT
+    return os.path.join(app.outdir, filename)
+
+
+def create_report(env):
+    items = [
+        {"docname": docname, **item}
+        for docname, doc_items in sorted(doc_data(env, "asdf_profile").items())
+        for item in doc_items
+    ]
+    items.sort(key=lambda item: item["total"], reverse=True)
+
+    totals = {}
+    for item in items:
+        total = totals.setdefault(item["kind"], {"count": 0, "total": 0.0})
+        total["count"] += 1
+        total["total"] += item["total"]
+
+    sizes = sorted(doc_data(env, "asdf_doctree_sizes").items(), key=lambda item: item[1], reverse=True)
+
+    return {
+        "build": getattr(env, "asdf_build_profile", {}),
+        "totals": totals,
+        "items": items,
+        "doctree_sizes": dict(sizes),
+    }
+
+
+def write_profile_report(app, exception):
+    if exception is not None or not profiling_enabled(app.env):
+        return
+
+    report = create_report(app.env)
+    filename = report_path(app)
+    with open(filename, "w") as fd:
+        json.dump(report, fd, indent=2)
+
+    logger.info("sphinx-asdf profile written to %s", filename)
+    for phase, elapsed in report["build"].items():
+        logger.info("    %-40s %8.3f s", phase, elapsed)
+    for kind, total in sorted(report["totals"].items()):
+        logger.info("    %-40s %8.3f s (%d directives)", kind, total["total"], total["count"])
+    if report["items"]:
+        logger.info("slowest directives:")
+    for item in report["items"][:PROFILE_SUMMARY_SIZE]:
+        phases = ", ".join(f"{phase} {elapsed:.3f} s" for phase, elapsed in item["phases"].items())
+        name = f"{item['kind']} {item['name']} ({item['docname']})"
+        logger.info("    %-40s %8.3f s%s", name, item["total"], f" [{phases}]" if phases else "")
+    if report["doctree_sizes"]:
+        logger.info("largest schema doctrees:")
+    for docname, size in list(report["doctree_sizes"].items())[:PROFILE_SUMMARY_SIZE]:
+        logger.info("    %-40s %8.1f KiB", docname, size / 1024)
@@ -0,0 +1,86 @@
+"""
+Resolution of the ids of referenced schemas to the URLs of their
+documentation, as configured by ``asdf_schema_reference_mappings``.
+"""
+
+import functools
+import posixpath
+
+from sphinx.errors import ConfigError
+
+REFERENCE_MAPPING_MATCHES = ("first", "longest")
+
+
+class ReferenceMappings:
+    """
+    The reference mappings compiled to a table of prefixes grouped by their
+    length. Finding the mapping of a schema id takes a dict lookup for each
+    distinct prefix length rather than a comparison with every prefix.
+
+    With ``match="first"`` the first of the configured mappings whose prefix
+    matches is used, with ``match="longest"`` the mapping with the longest
+    matching prefix is.
+    """
+
+    def __init__(self, mappings, match="first"):
+        if match not in REFERENCE_MAPPING_MATCHES:
+            msg = f"Unknown reference mapping match {match!r}, expected one of {REFERENCE_MAPPING_MATCHES}"
+            raise ValueError(msg)
+
+        self.mappings = mappings
+        self.match = match
+        self._prefixes = {}
+        for index, (prefix, _) in enumerate(mappings):
+            # Only the first of several mappings of the same prefix can match
+            self._prefixes.setdefault(len(prefix), {}).setdefault(prefix, index)
+        self._lengths = sorted(self._prefixes, reverse=True)
+        self.resolve = functools.lru_cache(maxsize=None)(self._resolve)
+
+    def find(self, schema_id):
+        """The index of the mapping of a schema id, or `None`"""
+        found = None
+        for length in self._lengths:
+            if length > len(schema_id):
+                continue
+            index = self._prefixes[length].get(schema_id[:length])
+            if index is None:
+                continue
+            if self.match == "longest":
+                return index
+            if found is None or index < found:
+                found = index
+        return found
+
+    def _resolve(self, schema_id):
+        index = self.find(schema_id)
+        if index is not None:
+            prefix, target = self.mappings[index]
+            relpath = posixpath.relpath(schema_id, prefix).strip("/")
+            if relpath == ".":
+                relpath = ""
+            schema_id = posixpath.join(target, relpath).strip("/")
+
+        if not schema_id.endswith(".html"):
+            schema_id += ".html"
+
+        return schema_id
+
+
+@functools.lru_cache(maxsize=8)
+def reference_mappings(mappings, match="first"):
+    """The compiled mappings, ``mappings`` must be a tuple of pairs"""
+    return ReferenceMappings(mappings, match)
+
+
+def config_reference_mappings(config):
+    mappings = tuple(tuple(mapping) for mapping in config.asdf_schema_reference_mappings)
+    return reference_mappings(mappings, config.asdf_schema_reference_mapping_match)
+
+
+def compile_reference_mappings(app, config):
+    # Compile the mappings before any document is read (or any reader
+    # process is forked) so that they are only compiled once
+    try:
+        config_reference_mappings(config)
+    except ValueError as err:
+        raise ConfigError(str(err)) from err
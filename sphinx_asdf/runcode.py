@@ -0,0 +1,195 @@
+"""
+Execution of the code of ``runcode`` blocks.
+
+The blocks of a document are executed by a runner that owns the namespace
+shared by the blocks. By default the blocks are executed in the Sphinx
+process itself. When ``asdf_runcode_workers`` is set each document gets its
+own worker process instead, so that a block that hangs or uses too much
+memory can be stopped without stopping the build.
+"""
+
+import multiprocessing
+import os
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class RunCodeError(Exception):
+    """A block could not be executed by a worker process"""
+
+
+class InProcessRunner:
+    """Executes blocks in the current process"""
+
+    def __init__(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.namespace = {}
+
+    def run(self, code):
+        # The code expects to run in the working directory of the document
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        try:
+            try:
+                exec(code, self.namespace)  # noqa: S102
+            except Exception:
+                print(code)
+                raise
+        finally:
+            os.chdir(cwd)
+
+    def close(self):
+        pass
+
+
+def _worker_main(conn, memory_limit):
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    namespace = {}
+    while True:
+        try:
+            command, arg = conn.recv()
+        except EOFError:
+            return
+
+        if command == "start":
+            # The worker belongs to a single document from now on
+            os.chdir(arg)
+        elif command == "run":
+            try:
+                exec(arg, namespace)  # noqa: S102
+            except BaseException as err:
+                # Leave this function out of the traceback
+                conn.send("".join(traceback.format_exception(type(err), err, err.__traceback__.tb_next)))
+            else:
+                conn.send(None)
+        else:
+            return
+
+
+class WorkerRunner:
+    """
+    Executes blocks in a worker process that was forked before the document
+    was read, so that the modules imported by Sphinx are already loaded.
+    """
+
+    def __init__(self, process, conn, tmpdir, timeout):
+        self.process = process
+        self.conn = conn
+        self.timeout = timeout or None
+        self.error = None
+        self.conn.send(("start", tmpdir))
+
+    def run(self, code):
+        if self.error is not None:
+            raise RunCodeError(f"not executed since an earlier block failed: {self.error}")
+
+        try:
+            self.conn.send(("run", code))
+            if not self.conn.poll(self.timeout):
+                self.close()
+                self.error = f"timed out after {self.timeout} seconds"
+                raise RunCodeError(self.error)
+            result = self.conn.recv()
+        except (EOFError, OSError):
+            self.close()
+            self.error = f"the worker process exited with code {self.process.exitcode}"
+            raise RunCodeError(self.error) from None
+
+        if result is not None:
+            raise RunCodeError(result)
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(("close", None))
+            except OSError:
+                pass
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Keeps a number of idle worker processes ready to execute the blocks of
+    the next documents. Every worker is only used for a single document, the
+    pool forks a replacement whenever one is taken.
+    """
+
+    def __init__(self, size, memory_limit):
+        self.size = size
+        self.memory_limit = memory_limit
+        self.pid = os.getpid()
+        self.idle = []
+        self.runners = []
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+    def _start_worker(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, self.memory_limit), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def runner(self, tmpdir, timeout):
+        while len(self.idle) < self.size + 1:
+            self.idle.append(self._start_worker())
+        runner = WorkerRunner(*self.idle.pop(0), tmpdir, timeout)
+        self.runners.append(runner)
+        return runner
+
+    def close(self):
+        for process, conn in self.idle:
+            conn.close()
+            process.join(1)
+            if process.is_alive():
+                process.kill()
+        for runner in self.runners:
+            runner.close()
+        self.idle = []
+        self.runners = []
+
+
+_pool = None
+
+
+def worker_pool(config):
+    global _pool
+    # The workers of a parent process can't be used by the processes Sphinx
+    # forks to read documents in parallel, each of them gets its own pool
+    if _pool is None or _pool.pid != os.getpid():
+        _pool = WorkerPool(config.asdf_runcode_workers, config.asdf_runcode_memory_limit)
+    return _pool
+
+
+def create_runner(env, tmpdir):
+    config = env.config
+    if not config.asdf_runcode_workers:
+        return InProcessRunner(tmpdir)
+    return worker_pool(config).runner(tmpdir, config.asdf_runcode_timeout)
+
+
+def close_runner(app, doctree):
+    """Stop the worker of a document once it has been read"""
+    state = app.env.temp_data.get("runcode")
+    if state is not None and state["runner"] is not None:
+        state["runner"].close()
+        if _pool is not None and state["runner"] in _pool.runners:
+            _pool.runners.remove(state["runner"])
+
+
+def close_worker_pool(app, exception):
+    global _pool
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+    _pool = None
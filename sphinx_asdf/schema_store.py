@@ -0,0 +1,90 @@
+"""
+A process-wide store of schema files that have been read and parsed, so
+that any schema only needs to be parsed once as long as it is unchanged.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import yaml
+
+from .cache import content_hash
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Total size (in characters of schema text) of the schemas kept in memory.
+# The least recently used schemas are evicted once this is exceeded.
+SCHEMA_STORE_SIZE = 64 * 1024 * 1024
+
+
+class SchemaEntry:
+    """
+    A schema file as both its raw text and the parsed tree. The tree is
+    shared between all users of the store and must not be modified.
+    """
+
+    __slots__ = ("digest", "mtime", "path", "raw", "tree")
+
+    def __init__(self, path, mtime, raw, tree):
+        self.path = path
+        self.mtime = mtime
+        self.raw = raw
+        self.tree = tree
+        self.digest = content_hash(raw.encode("utf-8"))
+
+
+class SchemaStore:
+    def __init__(self, maxsize=SCHEMA_STORE_SIZE):
+        self.maxsize = maxsize
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, path):
+        """Get the entry for a schema file, reading it if needed"""
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime == mtime:
+                self._entries.move_to_end(path)
+                return entry
+
+        with open(path) as ff:
+            raw = ff.read()
+        entry = SchemaEntry(path, mtime, raw, yaml.load(raw, Loader=SafeLoader))
+
+        with self._lock:
+            self._remove(path)
+            self._entries[path] = entry
+            self._size += len(raw)
+            # The newest entry is always kept, even when it is too large
+            while self._size > self.maxsize and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+        return entry
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._size -= len(entry.raw)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+schema_store = SchemaStore()
+
+
+def load_schema(path):
+    return schema_store.load(path)
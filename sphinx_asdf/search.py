@@ -0,0 +1,112 @@
+"""
+A compact search index of the properties of the documented schemas.
+
+The index lists the schema, id, type and title of every property and is
+written next to the static files of the HTML output, along with a small
+script that shows the properties matching a query on the search page. The
+general Sphinx search index can be kept free of the schema documentation
+with ``asdf_schema_exclude_from_search``.
+"""
+
+import json
+import os
+
+from .cache import atomic_write
+from .envdata import doc_data
+from .fastpath import schema_html
+from .nodes import schema_doc
+
+# Name of the index, relative to the static files of the output
+SEARCH_INDEX = "asdf_schema_search.js"
+
+# Only these builders have a search page
+SEARCH_BUILDERS = ("html", "dirhtml")
+
+# Titles are cut to this many characters
+SEARCH_TITLE_LENGTH = 80
+
+SEARCH_SCRIPT = """
+document.addEventListener("DOMContentLoaded", () => {
+  const query = new URLSearchParams(window.location.search).get("q");
+  const index = window.asdfSchemaIndex;
+  const results = document.getElementById("search-results");
+  if (!query || !index || !results) {
+    return;
+  }
+  const terms = query.toLowerCase().split(/\\s+/).filter(Boolean);
+  const matches = index.properties.filter(([schema, path, type, title]) => {
+    const text = `${index.schemas[schema][1]} ${path} ${type} ${title}`.toLowerCase();
+    return terms.every((term) => text.includes(term));
+  });
+  if (!matches.length) {
+    return;
+  }
+  const root = document.documentElement.dataset.content_root ?? "";
+  const section = document.createElement("div");
+  section.className = "asdf-schema-search";
+  const heading = document.createElement("h2");
+  heading.textContent = "Schema properties";
+  const list = document.createElement("ul");
+  for (const [schema, path, type, title] of matches.slice(0, 100)) {
+    const [uri, name] = index.schemas[schema];
+    const item = document.createElement("li");
+    const link = document.createElement("a");
+    link.href = `${root}${uri}#${path}`;
+    link.textContent = `${name}: ${path}`;
+    item.append(link, ` (${type}) ${title}`);
+    list.append(item);
+  }
+  section.append(heading, list);
+  results.before(section);
+});
+"""
+
+
+def _short_title(title):
+    if len(title) <= SEARCH_TITLE_LENGTH:
+        return title
+    return title[: SEARCH_TITLE_LENGTH - 3].rstrip() + "..."
+
+
+def create_search_index(builder):
+    schemas = []
+    properties = []
+    schema_ids = {}
+    data = doc_data(builder.env, "asdf_schema_properties")
+    for docname in sorted(data):
+        uri = builder.get_target_uri(docname)
+        for schema, path, typ, title in data[docname]:
+            key = (uri, schema)
+            if key not in schema_ids:
+                schema_ids[key] = len(schemas)
+                schemas.append(key)
+            properties.append((schema_ids[key], path, str(typ), _short_title(title)))
+    return {"schemas": schemas, "properties": properties}
+
+
+def add_search_script(app, pagename, templatename, context, doctree):
+    if pagename == "search" and app.config.asdf_schema_search_index:
+        app.add_js_file(SEARCH_INDEX)
+        app.add_js_file(None, body=SEARCH_SCRIPT)
+
+
+def exclude_from_search(app, doctree, docname):
+    """Keep the schema documentation out of the Sphinx search index"""
+    if app.config.asdf_schema_exclude_from_search:
+        for node in doctree.findall(lambda node: isinstance(node, (schema_doc, schema_html))):
+            node["classes"].append("no-search")
+
+
+def write_search_index(app):
+    """
+    Write the index while the extra pages are collected, which happens before
+    the search page is written, so that the checksum Sphinx appends to the URL
+    of the index on the search page is the one of this index.
+    """
+    if app.builder.name not in SEARCH_BUILDERS or not app.config.asdf_schema_search_index:
+        return []
+
+    index = json.dumps(create_search_index(app.builder), separators=(",", ":"))
+    with atomic_write(os.path.join(app.builder.outdir, "_static", SEARCH_INDEX)) as ff:
+        ff.write(f"window.asdfSchemaIndex = {index};\n".encode())
+    return []
@@ -0,0 +1,3 @@
+extensions = ["sphinx_asdf"]
+
+master_doc = "contents"
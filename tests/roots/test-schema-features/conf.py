@@ -0,0 +1,2 @@
+extensions = ["sphinx_asdf"]
+master_doc = "contents"
@@ -1,12 +1,21 @@
+import functools
+import json
 import os
 import pickle
+import posixpath
+import re
+import shutil
+import zlib
 from pathlib import Path
 from tempfile import gettempdir
 
 import pytest
 from docutils import nodes
+from sphinx import addnodes
+from sphinx.util.console import strip_colors
 
 from sphinx_asdf import nodes as sa_nodes
+from sphinx_asdf.directives import markdown_fragment
 
 
 @pytest.fixture(scope="session")
@@ -26,6 +35,41 @@ def sphinx_test_tempdir():
     return Path(os.environ.get("SPHINX_TEST_TEMPDIR", make_tmpdir())).absolute()
 
 
+@pytest.fixture
+def copy_root(make_app, rootdir, tmp_path):
+    """
+    Copy a test root (or start an empty one, for ``None``) in the temporary
+    directory and return a function that builds it with a new application.
+    The source directory is the ``srcdir`` attribute of the function.
+    """
+
+    def copy(root, name=None, buildername="html", **confoverrides):
+        srcdir = tmp_path / (name or root)
+        if root is None:
+            srcdir.mkdir(parents=True)
+        else:
+            shutil.copytree(rootdir / f"test-{root}", srcdir)
+
+        def build(buildername=buildername, freshenv=True, builddir=None, parallel=0, connect=(), **overrides):
+            app = make_app(
+                buildername,
+                srcdir=srcdir,
+                builddir=builddir,
+                freshenv=freshenv,
+                parallel=parallel,
+                confoverrides={**confoverrides, **overrides},
+            )
+            for event, handler in connect:
+                app.connect(event, handler)
+            app.build()
+            return app
+
+        build.srcdir = srcdir
+        return build
+
+    return copy
+
+
 @pytest.mark.sphinx("dummy", testroot="basic-generation")
 def test_basic_generation(app, status, warning):
     app.builder.build_all()
@@ -97,3 +141,933 @@ def test_basic_build(app, status, warning):
 
         schema_top = list(doc.findall(sa_nodes.schema_doc))
         assert len(schema_top) > 0
+
+
+def test_may_contain_autoschemas(tmp_path):
+    from sphinx_asdf.connections import may_contain_autoschemas
+
+    candidate = tmp_path / "candidate.rst"
+    candidate.write_text("Schemas\n=======\n\n.. asdf-autoschemas::\n\n   foo\n")
+    assert may_contain_autoschemas(str(candidate))
+
+    included = tmp_path / "included.rst"
+    included.write_text("  .. include:: schemas.inc\n")
+    assert may_contain_autoschemas(str(included))
+
+    upper = tmp_path / "upper.rst"
+    upper.write_text(".. ASDF-Autoschemas::\n\n   foo\n\n.. Include:: schemas.inc\n")
+    assert may_contain_autoschemas(str(upper))
+
+    plain = tmp_path / "plain.rst"
+    plain.write_text("Plain\n=====\n\nThis mentions asdf-autoschemas in passing.\n\n.. asdf-schema::\n\n   foo\n")
+    assert not may_contain_autoschemas(str(plain))
+
+    assert may_contain_autoschemas(str(tmp_path / "missing.rst"))
+
+
+@pytest.mark.sphinx("dummy", testroot="multiple-autoschemas")
+def test_parallel_discovery(app, status, warning):
+    from sphinx_asdf.connections import find_autoschema_references
+
+    genfiles = ["contents.rst", "core.rst", "other.rst", "plain.rst"]
+
+    def discover(workers):
+        # Make sure that every file is actually parsed
+        cache_file = app.doctreedir / "sphinx_asdf" / "discovery.pickle"
+        cache_file.unlink(missing_ok=True)
+        app.config.asdf_schema_discovery_workers = workers
+        schemas = find_autoschema_references(app, genfiles)
+        return [(s.astext(), s.schema_root, s.standard_prefix) for s in schemas]
+
+    serial = discover(0)
+    assert serial == [("bar", "schemas", ""), ("core/baz", "schemas", ""), ("foo", "schemas", "")]
+    assert discover(2) == serial
+
+
+@pytest.mark.sphinx("dummy", testroot="multiple-autoschemas")
+def test_discovery_cache(app, status, warning, monkeypatch):
+    from sphinx_asdf import connections
+
+    genfiles = ["contents.rst", "core.rst", "other.rst", "plain.rst"]
+    expected = connections.find_autoschema_references(app, genfiles)
+
+    parsed = []
+    read_schema_references = connections._read_schema_references
+
+    def spy(app, paths):
+        parsed.extend(os.path.basename(path) for path in paths)
+        return read_schema_references(app, paths)
+
+    monkeypatch.setattr(connections, "_read_schema_references", spy)
+
+    def discover():
+        parsed.clear()
+        schemas = connections.find_autoschema_references(app, genfiles)
+        assert [s.astext() for s in schemas] == [s.astext() for s in expected]
+        return sorted(parsed)
+
+    # Nothing changed since the previous discovery
+    assert discover() == []
+
+    # A new modification time alone doesn't trigger a re-parse
+    other = app.srcdir / "other.rst"
+    os.utime(other, ns=(0, 0))
+    assert discover() == []
+
+    # Only the modified file is parsed again
+    other.write_text(other.read_text() + "\n")
+    assert discover() == ["other.rst"]
+
+    # Changing the schema configuration invalidates the whole cache
+    app.config.asdf_schema_path = "schemas/"
+    assert discover() == ["core.rst", "other.rst"]
+
+
+@pytest.mark.sphinx("dummy", testroot="basic-generation")
+def test_schema_docs_regeneration(app, status, warning):
+    from sphinx_asdf.connections import autogenerate_schema_docs
+
+    autogenerate_schema_docs(app)
+
+    foo_doc = app.srcdir / "generated" / "foo.rst"
+    bar_doc = app.srcdir / "generated" / "bar.rst"
+    os.utime(foo_doc, ns=(0, 0))
+
+    # A stale document is rewritten, an up to date one is left untouched
+    bar_content = bar_doc.read_text()
+    bar_doc.write_text(bar_content.replace(":schema_root: schemas", ":schema_root: old"))
+    # Documents of schemas that are no longer listed are removed
+    stale_doc = app.srcdir / "generated" / "old" / "qux.rst"
+    stale_doc.parent.mkdir()
+    stale_doc.write_text(bar_content.replace("bar", "old/qux"))
+    other_doc = app.srcdir / "generated" / "notes.rst"
+    other_doc.write_text("Notes\n=====\n")
+
+    autogenerate_schema_docs(app)
+
+    assert foo_doc.stat().st_mtime_ns == 0
+    assert bar_doc.read_text() == bar_content
+    assert not stale_doc.parent.exists()
+    assert other_doc.exists()
+    other_doc.unlink()
+
+
+def test_md2rst_cache():
+    from sphinx_asdf.md2rst import md2rst
+
+    text = "Uses $x^2$ and **bold** text, see [the docs](https://asdf.readthedocs.io)"
+    expected = "Uses :math:`x^2` and **bold** text, see `the docs <https://asdf.readthedocs.io>`__\n"
+
+    assert md2rst(text) == expected
+    hits = md2rst.cache_info().hits
+    assert md2rst(text) == expected
+    assert md2rst.cache_info().hits == hits + 1
+
+
+def test_schema_store(tmp_path):
+    from sphinx_asdf.schema_store import SchemaStore
+
+    store = SchemaStore(maxsize=100)
+    foo = tmp_path / "foo.yaml"
+    foo.write_text("title: foo\n")
+    bar = tmp_path / "bar.yaml"
+    bar.write_text("title: bar\n" + "#" * 90 + "\n")
+
+    entry = store.load(foo)
+    assert entry.raw == "title: foo\n"
+    assert entry.tree == {"title": "foo"}
+    assert store.load(str(foo)) is entry
+
+    # Changed files are parsed again
+    foo.write_text("title: changed\n")
+    os.utime(foo, ns=(0, 0))
+    assert store.load(foo).tree == {"title": "changed"}
+
+    # The least recently used schema is evicted once the store is too large
+    store.load(bar)
+    assert len(store) == 1
+    assert store.load(bar).tree == {"title": "bar"}
+
+
+@pytest.mark.parametrize("schema", ["shape", "core/unit"])
+def test_batch_markdown(copy_root, schema):
+    def read_schema_doc(batch):
+        build = copy_root("schema-features", str(batch), "dummy")
+        # Warnings must be reported at the same location in both modes
+        schema_file = build.srcdir / "schemas" / "shape.yaml"
+        schema_file.write_text(schema_file.read_text().replace("Any **name** can", "Any **name can"))
+
+        app = build(asdf_schema_batch_markdown=batch)
+        doctree = app.env.get_doctree(f"generated/{schema}")
+        warnings = [
+            line.replace(str(build.srcdir), "") for line in app.warning.getvalue().splitlines() if "docutils" in line
+        ]
+        return next(iter(doctree.findall(sa_nodes.schema_doc))), warnings
+
+    batched, batched_warnings = read_schema_doc(True)
+    unbatched, unbatched_warnings = read_schema_doc(False)
+    assert not list(batched.findall(markdown_fragment))
+    assert batched.pformat() == unbatched.pformat()
+    assert "Inline strong start-string without end-string" in "".join(batched_warnings)
+    assert batched_warnings == unbatched_warnings
+
+
+def test_doctree_cache(copy_root, monkeypatch):
+    from sphinx_asdf.directives import AsdfSchema
+
+    build = copy_root("schema-features", buildername="dummy")
+    rendered = []
+    create_schema_doc = AsdfSchema._create_schema_doc
+
+    def spy(self, schema_entry, schema_file):
+        rendered.append(self.schema_name)
+        return create_schema_doc(self, schema_entry, schema_file)
+
+    monkeypatch.setattr(AsdfSchema, "_create_schema_doc", spy)
+
+    def read_schema_doc(**confoverrides):
+        rendered.clear()
+        doctree = build(**confoverrides).env.get_doctree("generated/shape")
+        return next(iter(doctree.findall(sa_nodes.schema_doc))).pformat()
+
+    uncached = read_schema_doc()
+    assert sorted(rendered) == ["core/unit", "shape"]
+
+    # Unchanged schemas are loaded from the cache
+    assert read_schema_doc() == uncached
+    assert rendered == []
+
+    # Changed schemas (or configuration) are rendered again
+    unit_file = build.srcdir / "schemas" / "core" / "unit.yaml"
+    unit_file.write_text(unit_file.read_text().replace("A unit", "A physical unit"))
+    read_schema_doc()
+    assert rendered == ["core/unit"]
+
+    mappings = [("http://stsci.edu/schemas", "https://asdf-standard.readthedocs.io")]
+    read_schema_doc(asdf_schema_reference_mappings=mappings)
+    assert sorted(rendered) == ["core/unit", "shape"]
+
+    # Each of several directives of a document has its own entry
+    (build.srcdir / "both.rst").write_text(
+        ":orphan:\n\n" + "".join(f".. asdf-schema::\n\n   {name}\n\n" for name in ["shape", "core/unit"] * 2)
+    )
+    read_schema_doc()
+    assert sorted(rendered) == ["core/unit", "core/unit", "shape", "shape"]
+    read_schema_doc()
+    assert rendered == []
+
+
+def test_schema_dependencies(copy_root):
+    build = copy_root("schema-features", buildername="dummy")
+
+    def read_docs():
+        read = []
+        build(freshenv=False, connect=[("env-before-read-docs", lambda app, env, docnames: read.extend(docnames))])
+        return sorted(read)
+
+    assert read_docs() == ["contents", "generated/core/unit", "generated/shape"]
+    assert read_docs() == []
+
+    # Changing a schema rebuilds its own page and the pages that reference it
+    unit_file = build.srcdir / "schemas" / "core" / "unit.yaml"
+    unit_file.write_text(unit_file.read_text().replace("A unit", "A physical unit"))
+    assert read_docs() == ["generated/core/unit", "generated/shape"]
+
+    shape_file = build.srcdir / "schemas" / "shape.yaml"
+    shape_file.write_text(shape_file.read_text().replace("A point", "A point in space"))
+    assert read_docs() == ["generated/shape"]
+
+
+@pytest.mark.sphinx("dummy", testroot="schema-features")
+def test_labels(app, status, warning):
+    app.build()
+
+    labels = app.env.domaindata["std"]["labels"]
+    schema_labels = {name: value for name, value in labels.items() if value[2] == ""}
+    assert schema_labels == {
+        "shape": ("generated/shape", "shape", ""),
+        "shape:name": ("generated/shape", "name", ""),
+        "shape:kind": ("generated/shape", "kind", ""),
+        "shape:dimensions": ("generated/shape", "dimensions", ""),
+        "shape:unit": ("generated/shape", "unit", ""),
+        "shape:origin": ("generated/shape", "origin", ""),
+        "shape:origin-anyof": ("generated/shape", "origin-anyof", ""),
+        "shape:style": ("generated/shape", "style", ""),
+        "shape:style-oneof": ("generated/shape", "style-oneof", ""),
+        "shape:style-oneof-1-color": ("generated/shape", "style-oneof-1-color", ""),
+        "shape:definitions-point": ("generated/shape", "definitions-point", ""),
+        "core/unit": ("generated/core/unit", "core-unit", ""),
+    }
+    assert app.env.domaindata["std"]["anonlabels"]["shape:name"] == ("generated/shape", "name")
+
+
+@pytest.mark.parametrize("root", ["runcode", "schema-features", "multiple-autoschemas"])
+def test_parallel_read(copy_root, root):
+    def build(parallel):
+        app = copy_root(root, f"j{parallel}")(parallel=parallel)
+        outputs = {
+            str(path.relative_to(app.outdir)): path.read_text()
+            for path in sorted(app.outdir.rglob("*.html"))
+            if "_static" not in path.parts
+        }
+        labels = {
+            name: value for name, value in app.env.domaindata["std"]["labels"].items() if value[0] in app.env.all_docs
+        }
+        references = {key: sorted(value) for key, value in app.env.asdf_schema_references.items()}
+        return outputs, labels, references
+
+    serial = build(1)
+    assert serial[0]
+    assert build(4) == serial
+
+
+def test_nested_document_tmpdirs(copy_root):
+    build = copy_root(None, "nested", asdf_runcode_cache=False)
+    srcdir = build.srcdir
+    (srcdir / "foo").mkdir()
+    (srcdir / "conf.py").write_text('extensions = ["sphinx_asdf"]\n')
+    (srcdir / "index.rst").write_text("Index\n=====\n\n.. toctree::\n\n   foo\n   foo/bar\n")
+    (srcdir / "foo.rst").write_text("Foo\n===\n\n.. runcode::\n\n   value = 1\n")
+    (srcdir / "foo" / "bar.rst").write_text(
+        "Bar\n===\n\n.. runcode::\n\n"
+        "   import time\n   import asdf\n\n"
+        "   time.sleep(1)\n"
+        '   asdf.AsdfFile({"value": 2}).write_to("test.asdf")\n'
+        "   time.sleep(1)\n\n"
+        ".. asdf:: test.asdf\n"
+    )
+
+    def read_foo_last(app, env, docnames):
+        docnames.sort(key=lambda name: name == "foo")
+
+    # Starting foo must not remove the files of foo/bar read at the same time
+    app = build(parallel=4, connect=[("env-before-read-docs", read_foo_last)])
+
+    assert "value: 2" in re.sub("<[^>]+>", "", (app.outdir / "foo" / "bar.html").read_text())
+    assert "test.asdf" not in strip_colors(app.warning.getvalue())
+
+
+@pytest.mark.parametrize("parallel", [1, 4])
+def test_profile(copy_root, rootdir, parallel):
+    build = copy_root("runcode")
+    contents = build.srcdir / "contents.rst"
+    contents.write_text(contents.read_text() + "\n.. asdf-autoschemas::\n   :schema_root: schemas\n\n   shape\n")
+    shutil.copytree(rootdir / "test-schema-features" / "schemas", build.srcdir / "schemas")
+
+    app = build(parallel=parallel, asdf_profile="profile.json")
+
+    report = json.loads((app.outdir / "profile.json").read_text())
+    assert set(report["build"]) == {"discovery", "stub generation"}
+    assert report["totals"]["runcode"]["count"] == 12
+    assert report["totals"]["asdf"]["count"] == 6
+    assert report["totals"]["asdf-schema"]["count"] == 1
+
+    (schema,) = [item for item in report["items"] if item["kind"] == "asdf-schema"]
+    assert schema["docname"] == "generated/shape"
+    assert schema["name"] == "shape"
+    assert {"yaml load", "markdown", "tree walk"} <= set(schema["phases"])
+    assert sum(schema["phases"].values()) <= schema["total"]
+    assert list(report["doctree_sizes"]) == ["generated/shape"]
+    assert [item["total"] for item in report["items"]] == sorted(
+        (item["total"] for item in report["items"]), reverse=True
+    )
+    assert "slowest directives:" in app.status.getvalue()
+
+
+def test_runcode_cache(copy_root, monkeypatch):
+    from sphinx_asdf import asdf2rst
+    from sphinx_asdf.asdf2rst import RunCodeDirective
+
+    build = copy_root("runcode")
+    executed = []
+    run_code = RunCodeDirective._exec
+
+    def spy(self, runner, code):
+        executed.append(code)
+        return run_code(self, runner, code)
+
+    monkeypatch.setattr(RunCodeDirective, "_exec", spy)
+
+    runners = []
+    create_runner = asdf2rst.create_runner
+
+    def runner_spy(env, tmpdir):
+        runners.append(env.docname)
+        return create_runner(env, tmpdir)
+
+    monkeypatch.setattr(asdf2rst, "create_runner", runner_spy)
+
+    def render(**confoverrides):
+        executed.clear()
+        runners.clear()
+        return (build(**confoverrides).outdir / "two.html").read_text()
+
+    uncached = render()
+    assert len(executed) == 12
+
+    # The files written by the blocks are restored from the cache, without
+    # starting a runner (or forking a worker)
+    assert render() == uncached
+    assert executed == []
+    assert runners == []
+
+    # The blocks before a changed block are executed again to recreate the namespace
+    two = build.srcdir / "two.rst"
+    two.write_text(two.read_text().replace("np.arange(value)", "np.arange(value + 1)"))
+    render(asdf_runcode_workers=1)
+    assert len(executed) == 2
+    assert "value = 2" in executed[0]
+    assert runners == ["two"]
+
+    # Changing a block invalidates all of the blocks after it
+    two.write_text(two.read_text().replace("value = 2", "value = 3"))
+    render()
+    assert len(executed) == 2
+
+    render(asdf_runcode_cache=False)
+    assert len(executed) == 12
+
+
+def test_prune_caches(copy_root, rootdir, monkeypatch):
+    import time
+
+    from sphinx_asdf import asdf2rst
+
+    build = copy_root("runcode", asdf_schema_validate_examples=True)
+    shutil.copytree(rootdir / "test-schema-features" / "schemas", build.srcdir / "schemas")
+    (build.srcdir / "schemas.rst").write_text(":orphan:\n\n.. asdf-schema::\n\n   shape\n")
+    monkeypatch.setattr(asdf2rst, "_asdf_outputs", {})
+    caches = ["schema_docs", "runcode", "asdf", "highlight/html", "examples"]
+
+    def entries(app):
+        cache_dir = Path(app.doctreedir) / "sphinx_asdf"
+        return {name: sorted(path.name for path in (cache_dir / name).rglob("*.pickle")) for name in caches}
+
+    used = entries(build())
+    assert all(used.values())
+
+    # Unused entries (here of an older version) are only removed by builds
+    # that read every document
+    app = build(freshenv=False)
+    for name in caches:
+        stale = Path(app.doctreedir) / "sphinx_asdf" / name / "00" / "stale.pickle"
+        stale.parent.mkdir(exist_ok=True)
+        stale.write_bytes(b"")
+        os.utime(stale, (time.time() - 60,) * 2)
+    build(freshenv=False)
+    assert entries(app) == {name: sorted([*names, "stale.pickle"]) for name, names in used.items()}
+
+    # Other builders don't use (or prune) the highlighting of the HTML builder
+    build("latex")
+    assert entries(app) == {**used, "highlight/html": sorted([*used["highlight/html"], "stale.pickle"])}
+    build()
+    assert entries(app) == used
+
+
+def test_runcode_workers(copy_root):
+    in_process = copy_root("runcode", "in-process", asdf_runcode_cache=False)
+    expected = (in_process().outdir / "two.html").read_text()
+
+    workers = copy_root("runcode", "workers", asdf_runcode_cache=False)
+    assert (workers(asdf_runcode_workers=2).outdir / "two.html").read_text() == expected
+
+    # A block that hangs or uses too much memory only fails its own document
+    one = workers.srcdir / "one.rst"
+    one.write_text(one.read_text().replace("value = 1", "while True:\n       pass"))
+    two = workers.srcdir / "two.rst"
+    two.write_text(two.read_text().replace("value = 2", "value = bytearray(2**34)"))
+    app = workers(asdf_runcode_workers=1, asdf_runcode_timeout=2, asdf_runcode_memory_limit=2**33)
+
+    warnings = strip_colors(app.warning.getvalue())
+    assert "one.rst:4: ERROR: runcode block failed:\ntimed out after 2 seconds" in warnings
+    assert "one.rst:12: ERROR: runcode block failed:\nnot executed since an earlier block failed" in warnings
+    assert "two.rst:4: ERROR: runcode block failed:\nTraceback" in warnings
+    assert "MemoryError" in warnings
+    assert "BLOCK 0" in (app.outdir / "three.html").read_text()
+
+
+def test_block_reader(tmp_path):
+    import asdf
+    import numpy as np
+    from asdf.tags.core import Stream
+
+    from sphinx_asdf.asdf2rst import BLOCK_PREVIEW_SIZE, _block_to_string
+    from sphinx_asdf.blocks import BlockReader
+
+    tree = {"small": np.arange(3, dtype=np.uint8), "zlib": np.arange(5000), "bzp2": np.linspace(0, 1, 3000)}
+    af = asdf.AsdfFile(tree)
+    af.set_array_compression(tree["zlib"], "zlib")
+    af.set_array_compression(tree["bzp2"], "bzp2")
+    af.write_to(tmp_path / "test.asdf")
+
+    with BlockReader(tmp_path / "test.asdf", BLOCK_PREVIEW_SIZE + 1) as reader:
+        assert reader.yaml_header().startswith(b"#ASDF 1.0.0\n")
+        assert reader.yaml_header().endswith(b"\n...\n")
+
+        blocks = list(reader.blocks())
+        assert [block.header["compression"] for block in blocks] == [b"\0\0\0\0", b"zlib", b"bzp2"]
+        for block, array in zip(blocks, tree.values()):
+            assert block.header["data_size"] == array.nbytes
+            assert block.data == array.tobytes()[: BLOCK_PREVIEW_SIZE + 1]
+        assert reader.block_index(blocks[-1].end).startswith(b"#ASDF BLOCK INDEX\n")
+
+        assert _block_to_string(blocks[0].header, blocks[0].data) == (
+            "    allocated_size: 3\n    used_size: 3\n    data_size: 3\n    data: b'000102'"
+        )
+        assert _block_to_string(blocks[1].header, blocks[1].data).endswith(
+            "    data_size: 40000\n    data: b'0000000000000000010000000000000002000000...'"
+        )
+
+    af = asdf.AsdfFile({"stream": Stream([2], np.float64)})
+    with open(tmp_path / "stream.asdf", "wb") as fd:
+        af.write_to(fd)
+        fd.write(np.arange(6, dtype=np.float64).tobytes())
+
+    with BlockReader(tmp_path / "stream.asdf", BLOCK_PREVIEW_SIZE + 1) as reader:
+        (block,) = reader.blocks()
+        assert block.header["flags"] & asdf.constants.BLOCK_FLAG_STREAMED
+        assert block.data == np.arange(6, dtype=np.float64).tobytes()[: BLOCK_PREVIEW_SIZE + 1]
+
+
+@pytest.mark.parametrize("compression", ["zlib", "bzp2"])
+def test_block_reader_compressed_preview(tmp_path, compression):
+    import tracemalloc
+
+    import asdf
+    import numpy as np
+
+    from sphinx_asdf.blocks import BlockReader
+
+    zeros = np.zeros(32 * 2**20, dtype=np.uint8)
+    af = asdf.AsdfFile({"zeros": zeros})
+    af.set_array_compression(zeros, compression)
+    af.write_to(tmp_path / "test.asdf")
+    del af, zeros
+
+    # Only the preview is decompressed, not the whole block
+    tracemalloc.start()
+    try:
+        with BlockReader(tmp_path / "test.asdf", 21) as reader:
+            (block,) = reader.blocks()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert block.data == bytes(21)
+    assert peak < 2**20
+
+
+def test_asdf_cache(copy_root, monkeypatch):
+    from sphinx_asdf import asdf2rst
+
+    build = copy_root("runcode")
+    # The same file is shown twice by a page, the second time without the header
+    one = build.srcdir / "one.rst"
+    one.write_text(one.read_text() + "\n.. asdf:: test.asdf no_header\n")
+
+    described = []
+    describe = asdf2rst.AsdfDirective._describe
+
+    def spy(self, path, show_header, show_blocks):
+        described.append(self.arguments)
+        return describe(self, path, show_header, show_blocks)
+
+    monkeypatch.setattr(asdf2rst.AsdfDirective, "_describe", spy)
+    monkeypatch.setattr(asdf2rst, "_asdf_outputs", {})
+
+    def render():
+        described.clear()
+        return (build().outdir / "one.html").read_text()
+
+    uncached = render()
+    assert len(described) == 7
+    assert uncached.count("BLOCK 0") == 2
+
+    assert render() == uncached
+    assert described == []
+
+    # The rendered output is also kept on disk
+    asdf2rst._asdf_outputs.clear()
+    assert render() == uncached
+    assert described == []
+
+    two = build.srcdir / "two.rst"
+    two.write_text(two.read_text().replace("value = 2", "value = 7"))
+    render()
+    assert described == [["test.asdf"]]
+
+    # Pages showing files with the same content share the output
+    two.write_text(two.read_text().replace("value = 7", "value = 3"))
+    render()
+    assert described == []
+
+
+def test_reference_mappings():
+    from sphinx_asdf.references import ReferenceMappings
+
+    mappings = (
+        ("http://stsci.edu/schemas/asdf", "https://asdf-standard.readthedocs.io/en/latest/generated/stsci.edu/asdf"),
+        ("http://stsci.edu/schemas/asdf/core", "core-docs"),
+        ("http://stsci.edu/schemas/asdf", "unused"),
+        ("http://example.org", "example"),
+    )
+
+    def legacy_resolve(schema_id):
+        for prefix, target in mappings:
+            if schema_id.startswith(prefix):
+                relpath = posixpath.relpath(schema_id, prefix).strip("/")
+                if relpath == ".":
+                    relpath = ""
+                schema_id = posixpath.join(target, relpath).strip("/")
+                break
+        if not schema_id.endswith(".html"):
+            schema_id += ".html"
+        return schema_id
+
+    first = ReferenceMappings(mappings)
+    schema_ids = [
+        "http://stsci.edu/schemas/asdf/core/ndarray-1.0.0",
+        "http://stsci.edu/schemas/asdf",
+        "http://example.org/other-1.0.0",
+        "http://example.com/other-1.0.0",
+        "core/unit",
+        "core/unit.html",
+    ]
+    for schema_id in schema_ids:
+        assert first.resolve(schema_id) == legacy_resolve(schema_id)
+
+    longest = ReferenceMappings(mappings, match="longest")
+    assert longest.resolve("http://stsci.edu/schemas/asdf/core/ndarray-1.0.0") == "core-docs/ndarray-1.0.0.html"
+    assert longest.resolve("http://stsci.edu/schemas/asdf/fits/fits-1.0.0") == (
+        "https://asdf-standard.readthedocs.io/en/latest/generated/stsci.edu/asdf/fits/fits-1.0.0.html"
+    )
+
+    with pytest.raises(ValueError, match="Unknown reference mapping match"):
+        ReferenceMappings(mappings, match="shortest")
+
+
+def test_expand_refs(copy_root, monkeypatch):
+    from sphinx_asdf.directives import AsdfSchema
+
+    build = copy_root("schema-features", buildername="dummy")
+    srcdir = build.srcdir
+    (srcdir / "schemas" / "cycle").mkdir()
+    for name, other in [("a", "b"), ("b", "a")]:
+        (srcdir / "schemas" / "cycle" / f"{name}.yaml").write_text(
+            f'id: "http://example.org/cycle/{name}-1.0.0"\n'
+            f"title: Schema {name}\n"
+            "type: object\n"
+            "properties:\n"
+            "  next:\n"
+            f'    $ref: "{other}-1.0.0"\n'
+        )
+
+    def schema_page(name, depth):
+        return f".. asdf-schema::\n   :expand_refs: {depth}\n\n   {name}\n"
+
+    (srcdir / "expanded.rst").write_text(schema_page("shape", 1) + "\n" + schema_page("cycle/a", 5))
+    (srcdir / "again.rst").write_text(schema_page("shape", 2))
+    (srcdir / "plain.rst").write_text(schema_page("shape", 0))
+
+    rendered = []
+    render_expansion = AsdfSchema._render_expansion
+
+    def spy(self, path):
+        rendered.append(Path(path).relative_to(srcdir / "schemas").as_posix())
+        return render_expansion(self, path)
+
+    monkeypatch.setattr(AsdfSchema, "_render_expansion", spy)
+
+    app = build()
+
+    def expansions(docname):
+        doctree = app.env.get_doctree(docname)
+        return [node.astext().split("\n")[0] for node in doctree.findall(sa_nodes.schema_expansion)]
+
+    assert expansions("plain") == []
+    # References are only followed once around a cycle
+    assert expansions("expanded") == ["A unit", "Schema b"]
+    # The unit schema is only rendered once for both pages
+    assert expansions("again") == ["A unit"]
+    assert sorted(rendered) == ["core/unit.yaml", "cycle/b.yaml"]
+
+    # The ids of the expanded properties are relative to the reference
+    doctree = app.env.get_doctree("expanded")
+    expansion = next(iter(doctree.findall(sa_nodes.schema_expansion)))
+    assert expansion.parent["id"] == "unit"
+    assert {node["id"] for node in expansion.findall(sa_nodes.schema_properties)} == {"unit"}
+    doctree = app.env.get_doctree("again")
+    assert "next" not in doctree.astext()
+    doctree = app.env.get_doctree("expanded")
+    assert {node["id"] for node in doctree.findall(sa_nodes.schema_property)} >= {"next", "next-next"}
+
+
+def test_lazy_sections(copy_root):
+    build = copy_root("schema-features")
+
+    def shape_page(app):
+        return (app.outdir / "generated" / "shape.html").read_text()
+
+    page = shape_page(build())
+    assert "asdf-lazy" not in page
+    assert "minLength" in page
+    assert 'id="style-oneof-1-color"' in page
+
+    app = build(asdf_schema_lazy_depth=1, asdf_schema_lazy_original=True)
+    lazy_page = shape_page(app)
+    assert len(lazy_page) < len(page)
+    assert "minLength" not in lazy_page
+    # The color property of the style is nested below the first level
+    assert 'id="style-oneof-1-color"' not in lazy_page
+    assert "Show nested properties" in lazy_page
+    assert "Show the original schema" in lazy_page
+
+    sections = {}
+    for src in re.findall(r'data-src="([^"]+)"', lazy_page):
+        assert src.startswith("../_asdf/")
+        sections[src] = json.loads((app.outdir / "generated" / src).read_text())["html"]
+    assert len(sections) == 2
+    assert any('id="style-oneof-1-color"' in html for html in sections.values())
+    assert any("minLength" in html for html in sections.values())
+
+    # Builds that write every page remove the files they don't use
+    def section_files():
+        return sorted(path.name for path in (app.outdir / "_asdf").iterdir())
+
+    def loaded_files():
+        pages = "".join(path.read_text() for path in app.outdir.rglob("*.html"))
+        return sorted({posixpath.basename(src) for src in re.findall(r'data-src="([^"]+)"', pages)})
+
+    files = section_files()
+    assert files == loaded_files()
+    contents = build.srcdir / "contents.rst"
+    contents.write_text(contents.read_text() + "\nMore text.\n")
+    build(freshenv=False, asdf_schema_lazy_depth=1, asdf_schema_lazy_original=True)
+    assert section_files() == files
+    build(freshenv=False, asdf_schema_lazy_original=True)
+    assert len(section_files()) < len(files)
+    assert section_files() == loaded_files()
+    build(freshenv=False)
+    assert section_files() == []
+
+
+def test_search_index(copy_root, monkeypatch):
+    from sphinx.builders.html import _assets as sphinx_assets
+
+    build = copy_root("schema-features")
+    app = build()
+    text = (app.outdir / "_static" / "asdf_schema_search.js").read_text()
+    index = json.loads(text[text.index("{") : text.rindex("}") + 1])
+    schemas = [tuple(schema) for schema in index["schemas"]]
+    # The unit schema has no properties
+    assert schemas == [("generated/shape.html", "shape")]
+    properties = {path: (schemas[schema][1], typ, title) for schema, path, typ, title in index["properties"]}
+    assert properties["dimensions"] == ("shape", "array", "Size of each dimension")
+    assert properties["unit"] == ("shape", "core/unit", "Unit of the dimensions")
+    assert properties["style-oneof-1-color"] == ("shape", "string", "")
+    assert "asdf_schema_search.js" not in (app.outdir / "contents.html").read_text()
+
+    # The search page loads the index written by the same build
+    def checksum():
+        (version,) = re.findall(r"asdf_schema_search\.js\?v=(\w+)", (app.outdir / "search.html").read_text())
+        return version
+
+    assert checksum() == f"{zlib.crc32((app.outdir / '_static' / 'asdf_schema_search.js').read_bytes()):08x}"
+    title = build.srcdir / "schemas" / "shape.yaml"
+    title.write_text(title.read_text().replace("Size of each dimension", "Size of every dimension"))
+    # Sphinx remembers the checksum of each file for the rest of the process
+    monkeypatch.setattr(
+        sphinx_assets, "_file_checksum_inner", functools.cache(sphinx_assets._file_checksum_inner.__wrapped__)
+    )
+    app = build()
+    assert checksum() == f"{zlib.crc32((app.outdir / '_static' / 'asdf_schema_search.js').read_bytes()):08x}"
+    # The documents a word is found in
+    indexed = re.compile(r'"polygon":\[?\d')
+    assert indexed.search((app.outdir / "searchindex.js").read_text())
+
+    app = build(asdf_schema_exclude_from_search=True, asdf_schema_search_index=False)
+    assert "asdf_schema_search.js" not in (app.outdir / "search.html").read_text()
+    assert not indexed.search((app.outdir / "searchindex.js").read_text())
+
+
+@pytest.mark.parametrize("expand_refs", [0, 1])
+def test_html_fast_path(copy_root, tmp_path, expand_refs):
+    from sphinx_asdf.fastpath import schema_html
+
+    build = copy_root("schema-features")
+    (build.srcdir / "expanded.rst").write_text(f".. asdf-schema::\n   :expand_refs: {expand_refs}\n\n   shape\n")
+
+    app = build(builddir=tmp_path / "build", asdf_schema_html_fast_path=False)
+    fast_app = build(builddir=tmp_path / "fast-build", asdf_schema_html_fast_path=True)
+
+    doctree = fast_app.env.get_doctree("expanded")
+    assert not list(doctree.findall(sa_nodes.schema_property))
+    assert len(list(doctree.findall(schema_html))) == 1
+    assert len(pickle.dumps(doctree)) < len(pickle.dumps(app.env.get_doctree("expanded")))
+
+    # The labels of the properties are still added
+    assert fast_app.env.domaindata["std"]["labels"]["shape:dimensions"] == ("generated/shape", "dimensions", "")
+
+    for page in ["expanded.html", "generated/shape.html", "generated/core/unit.html"]:
+        assert (fast_app.outdir / page).read_text() == (app.outdir / page).read_text()
+
+
+def test_compact_doctrees(copy_root, tmp_path):
+    build = copy_root(None, "large")
+    srcdir = build.srcdir
+    (srcdir / "schemas").mkdir()
+    (srcdir / "conf.py").write_text('extensions = ["sphinx_asdf"]\n')
+    (srcdir / "index.rst").write_text(".. asdf-schema::\n\n   large\n")
+
+    # A schema with a few hundred nested properties
+    lines = ["title: A large schema", "type: object", "properties:"]
+    for i in range(20):
+        lines += [f"  group{i}:", f"    title: Group {i}", "    type: object", "    properties:"]
+        for j in range(20):
+            lines += [
+                f"      value{j}:",
+                f"        title: Value {j} of group {i}",
+                f"        description: The *value* number {j}.",
+                "        type: integer",
+                "        minimum: 0",
+            ]
+    (srcdir / "schemas" / "large.yaml").write_text("\n".join(lines) + "\n")
+
+    def add_xref(app, doctree):
+        # A cross-reference in the schema documentation, as added by the
+        # roles of other extensions
+        paragraph = next(doctree.findall(sa_nodes.schema_doc)).next_node(nodes.paragraph)
+        paragraph += addnodes.pending_xref(
+            "", nodes.inline("", "the index"), refdomain="std", reftype="doc", reftarget="/index", refexplicit=True
+        )
+
+    app = build(builddir=tmp_path / "build", connect=[("doctree-read", add_xref)])
+    compact_app = build(
+        builddir=tmp_path / "compact-build", connect=[("doctree-read", add_xref)], asdf_schema_compact_doctrees=True
+    )
+    assert 'href="#"><span class="doc">the index</span></a>' in (compact_app.outdir / "index.html").read_text()
+
+    size = (Path(app.doctreedir) / "index.doctree").stat().st_size
+    compact_size = (Path(compact_app.doctreedir) / "index.doctree").stat().st_size
+    assert compact_size < 64 * 1024
+    assert compact_size * 10 < size
+    assert (compact_app.outdir / "index.html").read_text() == (app.outdir / "index.html").read_text()
+
+
+def test_highlight_cache(copy_root, monkeypatch):
+    from sphinx.highlighting import PygmentsBridge
+
+    build = copy_root("schema-features")
+    contents = build.srcdir / "contents.rst"
+    contents.write_text(contents.read_text() + "\n.. code-block:: python\n\n   x = 1\n")
+
+    highlighted = []
+    highlight_block = PygmentsBridge.highlight_block
+
+    def spy(self, source, lang, *args, **kwargs):
+        highlighted.append(lang)
+        return highlight_block(self, source, lang, *args, **kwargs)
+
+    monkeypatch.setattr(PygmentsBridge, "highlight_block", spy)
+
+    def render(**confoverrides):
+        highlighted.clear()
+        return (build(**confoverrides).outdir / "generated" / "shape.html").read_text()
+
+    page = render()
+    assert highlighted.count("yaml") == 3
+    assert "python" in highlighted
+
+    # The YAML is only highlighted again when it (or the style) changes
+    assert render() == page
+    assert highlighted == ["python"]
+
+    render(pygments_style="friendly")
+    assert highlighted.count("yaml") == 3
+
+    assert render(asdf_highlight_cache=False) == page
+    assert highlighted.count("yaml") == 3
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_validate_examples(copy_root, monkeypatch, workers):
+    from sphinx_asdf import examples
+
+    build = copy_root(
+        "schema-features",
+        buildername="dummy",
+        asdf_schema_validate_examples=True,
+        asdf_schema_validation_workers=workers,
+    )
+    schema_file = build.srcdir / "schemas" / "shape.yaml"
+    schema_file.write_text(
+        schema_file.read_text()
+        .replace(
+            "          dimensions: [2, 2]\n",
+            "          dimensions: [2, -2]\n"
+            "  -\n"
+            "    - A shape without a name\n"
+            "    - |\n"
+            "        !<tag:stsci.edu:sphinx-asdf/testing/shape-1.0.0>\n"
+            "          kind: ellipse\n"
+            "  -\n"
+            "    - A shape with a unit\n"
+            "    - |\n"
+            "        !<tag:stsci.edu:sphinx-asdf/testing/shape-1.0.0>\n"
+            "          name: circle\n"
+            "          kind: ellipse\n"
+            "          unit: !<tag:stsci.edu:sphinx-asdf/testing/core/unit-1.0.0> m\n"
+            "  -\n"
+            "    - A shape with an outline\n"
+            "    - |\n"
+            "        !<tag:stsci.edu:sphinx-asdf/testing/shape-1.0.0>\n"
+            "          name: circle\n"
+            "          kind: ellipse\n"
+            "          outline: dashed\n",
+        )
+        .replace(
+            "  origin:\n",
+            '  outline:\n    $ref: "http://example.com/schemas/outline-1.0.0"\n  origin:\n',
+        )
+    )
+
+    validated = []
+    validate_example = examples.validate_example
+
+    def spy(schema_path, schema_root, text):
+        validated.append(text)
+        return validate_example(schema_path, schema_root, text)
+
+    monkeypatch.setattr(examples, "validate_example", spy)
+
+    def validate(**confoverrides):
+        validated.clear()
+        app = build(**confoverrides)
+        warnings = strip_colors(app.warning.getvalue()).splitlines()
+        return [line for line in warnings if " of schema " in line], strip_colors(app.status.getvalue())
+
+    # The reference to core/unit is resolved to the schema in the schema root,
+    # the one to an unknown schema is not reported as a problem of the example
+    warnings, status = validate()
+    assert warnings == [
+        f"{schema_file}:23: WARNING: invalid example 1 of schema shape: -2 is less than the minimum of 0 "
+        "(at dimensions/1)",
+        f"{schema_file}:30: WARNING: invalid example 2 of schema shape: 'name' is a required property",
+    ]
+    assert f"{schema_file}:42: example 4 of schema shape could not be validated: " in status
+    if not workers:
+        assert len(validated) == 4
+
+    # Unchanged examples of unchanged schemas are not validated again
+    assert len(validate()[0]) == 2
+    assert validated == []
+
+    # Examples are validated again when a schema referenced by their schema changes
+    unit_file = build.srcdir / "schemas" / "core" / "unit.yaml"
+    unit_file.write_text(unit_file.read_text().replace("type: string\n", "type: string\nminLength: 2\n"))
+    assert validate()[0][2:] == [
+        f"{schema_file}:35: WARNING: invalid example 3 of schema shape: 'm' is too short (at unit)",
+    ]
+    if not workers:
+        assert len(validated) == 4
+
+    assert validate(asdf_schema_validate_examples=False)[0] == []